@@ -0,0 +1,167 @@
+"""Asyncio GSA rate lookups that coalesce concurrent requests for the same destination."""
+import asyncio
+import csv
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import perdiem
+from run_metrics import METRICS
+
+MAX_PENDING_ROWS = 10000  # stays held waiting on GSA requests before reading pauses
+YIELD_ROWS = 256  # stays read between giving in-flight requests a turn on the event loop
+
+
+class AsyncGsaRates(object):
+    """
+    Non-blocking GSA destination rates over a perdiem.GsaRateProvider.
+    Requests run on the provider's pooled session in a pool of concurrency threads and take tokens from the
+    provider's rate limiter, so sync and async callers in one process share one request rate.
+    Concurrent lookups of the same rate key wait on one request. Keys that fail are remembered and answer None.
+    Keys GSA has no rates for answer the provider's fallback rate or None.
+    """
+
+    def __init__(self, rates=None, concurrency=perdiem.FETCH_WORKERS):
+        self.rates = perdiem.GSA_RATES if rates is None else rates
+        self.concurrency = concurrency
+        self.failures = {}  # rate_key -> error message
+        self._inflight = {}  # rate_key -> asyncio.Task
+        self._executor = ThreadPoolExecutor(concurrency)
+        self._requests = asyncio.Semaphore(concurrency)
+        self._limiter_lock = asyncio.Lock()  # one waiter polls the token bucket at a time
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown()
+
+    def lookup_nowait(self, state, city, zipcode, fiscal_year):
+        """
+        A destination rate, None for a key that failed, or while its request is in flight an asyncio future of either.
+        Never raises for a missing rate.
+        """
+        rate_key = perdiem.get_rate_key(fiscal_year, zipcode, state)
+        if rate_key in self.failures:
+            self.rates.metrics.incr('cache.failure_hits')
+            return None
+        destination = self.rates.get_local_rate(state, city, zipcode, fiscal_year)
+        if destination is not None or self.rates.is_missing(rate_key):
+            return destination
+        task = self._inflight.get(rate_key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(rate_key, state, city, zipcode, fiscal_year))
+            self._inflight[rate_key] = task
+        else:
+            self.rates.metrics.incr('cache.inflight_hits')
+        return task
+
+    async def get_destination_rate(self, state, city, zipcode, fiscal_year):
+        """Get GSA rates for a destination, or None when GSA has no rates or the request failed."""
+        result = self.lookup_nowait(state, city, zipcode, fiscal_year)
+        if isinstance(result, asyncio.Future):
+            return await asyncio.shield(result)
+        return result
+
+    async def _acquire(self):
+        limiter = perdiem.GSA_RATE_LIMITER if self.rates.limiter is None else self.rates.limiter
+        waited = 0.0
+        async with self._limiter_lock:
+            wait = limiter.try_acquire()
+            while wait:
+                await asyncio.sleep(wait)
+                waited += wait
+                wait = limiter.try_acquire()
+        self.rates.metrics.observe('gsa.limiter_wait_seconds', waited)
+
+    async def _fetch(self, rate_key, state, city, zipcode, fiscal_year):
+        try:
+            self.rates.metrics.incr('cache.misses')
+            async with self._requests:
+                await self._acquire()
+                gsa_response = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, perdiem.request_gsa_destination, state, city, zipcode, fiscal_year,
+                    self.rates.session, self.rates.metrics)
+            return self.rates.store_response(state, city, zipcode, fiscal_year, gsa_response)
+        except perdiem.NoGsaRates as e:
+            print(e)
+            self.rates.record_missing(rate_key, str(e))
+            return self.rates.fallback_rate(state, fiscal_year)
+        except Exception as e:
+            print(e)
+            self.failures[rate_key] = str(e)
+            return None
+        finally:
+            del self._inflight[rate_key]
+
+
+async def enrich_stays(data, output_csv, gsa_rates, max_pending=MAX_PENDING_ROWS):
+    """
+    Add GSA perdiem to the non-Utah stays while their GSA requests are in flight.
+    Rows are written in input order, the same as perdiem.add_perdiem_from_gsa.
+    - gsa_rates: AsyncGsaRates.
+    - max_pending: stays held waiting on requests before reading pauses.
+    """
+    with open(data, 'r') as stays, open(output_csv, 'w', newline='') as output:
+        reader = csv.DictReader(stays)
+        writer = csv.writer(output)
+        if 'PERDIEM' not in reader.fieldnames:
+            writer.writerow(reader.fieldnames + ['PERDIEM'])
+        else:
+            writer.writerow(reader.fieldnames)
+        pending = deque()  # (row, fiscal_month, destination or its in-flight future)
+        write_seconds = 0.0
+
+        def write_ready():
+            nonlocal write_seconds
+            while pending and not (isinstance(pending[0][2], asyncio.Future) and not pending[0][2].done()):
+                row, fiscal_month, destination = pending.popleft()
+                if isinstance(destination, asyncio.Future):
+                    destination = destination.result()
+                if destination is None:
+                    METRICS.skip('no GSA rate')
+                    continue
+                start = time.perf_counter()
+                row['PERDIEM'] = destination.get_rate(fiscal_month)
+                writer.writerow([row[field] for field in reader.fieldnames])
+                write_seconds += time.perf_counter() - start
+
+        for rows_read, row in enumerate(reader, 1):
+            METRICS.row()
+            if rows_read % YIELD_ROWS == 0:
+                await asyncio.sleep(0)
+            if row['STATE'].strip() == 'UT':  # Utah stays are run on separate utah specific rates.
+                continue
+            try:
+                state, city, zipcode, fiscal_year, fiscal_month = perdiem.parse_gsa_stay(row)
+            except ValueError:
+                print('BAD CHECKIN', row['ROW_ID'].strip(), row['CHECKIN_DATE'].strip())
+                METRICS.skip('bad checkin')
+                continue
+
+            pending.append((row, fiscal_month, gsa_rates.lookup_nowait(state, city, zipcode, fiscal_year)))
+            write_ready()
+            if len(pending) >= max_pending:
+                await asyncio.wait([pending[0][2]])
+                write_ready()
+
+        while pending:
+            await asyncio.wait([pending[0][2]])
+            write_ready()
+        METRICS.incr('time.write', write_seconds)
+
+
+def add_perdiem_from_gsa(data, output_csv, fetch_workers=perdiem.FETCH_WORKERS, rates=None):
+    """
+    Add GSA perdiem to hotel stays for non-Utah data, reading the stays while GSA requests are in flight.
+    Same signature and output as perdiem.add_perdiem_from_gsa. rates: perdiem.GsaRateProvider.
+    """
+    async def run():
+        async with AsyncGsaRates(rates, max(fetch_workers, 1)) as gsa_rates:
+            await enrich_stays(data, output_csv, gsa_rates)
+
+    with METRICS.timer('gsa_stays'):
+        asyncio.run(run())
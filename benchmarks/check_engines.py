@@ -0,0 +1,85 @@
+"""
+Run perdiem.py the way it is run in production, once per engine, against synthetic stays and the stub GSA API, and
+check that every engine writes the same per diems and skips the same stays.
+
+    python benchmarks/check_engines.py --rows 5000 --empty-rate 0.1 --fallback standard
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from run_benchmarks import REPO_FOLDER
+from stub_gsa_server import StubGsaServer
+from synthetic_stays import generate_stays
+
+ENGINES = {'csv': [], 'csv-staged': ['--staged'], 'pandas': ['--engine', 'pandas'], 'async': ['--engine', 'async']}
+
+
+def read_perdiems(results_csv):
+    """{ROW_ID: PERDIEM} of a combined results csv."""
+    with open(results_csv, 'r') as results:
+        return {row['ROW_ID']: row['PERDIEM'] for row in csv.DictReader(results)}
+
+
+def run_engine(engine, stays, workdir, url, extra_args):
+    """Run the perdiem.py command line for one engine on a fresh rate cache. Returns (perdiems, run report)."""
+    engine_folder = os.path.join(workdir, engine)
+    os.makedirs(os.path.join(engine_folder, 'results'))
+    shutil.copy(os.path.join(REPO_FOLDER, 'utah_rates.csv'), engine_folder)
+    subprocess.run([sys.executable, os.path.join(REPO_FOLDER, 'perdiem.py'), '--stays', stays,
+                    '--rates-db', os.path.join(engine_folder, 'rates.sqlite'), '--metrics', 'report.json']
+                   + ENGINES[engine] + extra_args,
+                   cwd=engine_folder, env=dict(os.environ, GSA_API_URL=url), stdout=subprocess.DEVNULL, check=True)
+    with open(os.path.join(engine_folder, 'report.json'), 'r') as report_file:
+        report = json.load(report_file)
+    return read_perdiems(os.path.join(engine_folder, 'results', 'results_2020_q3.csv')), report
+
+
+def check_engines(args):
+    """Returns the engines whose results differ from the first engine's."""
+    workdir = tempfile.mkdtemp(prefix='perdiem_engines_')
+    server = StubGsaServer(args.latency, empty_rate=args.empty_rate).start()
+    extra_args = ['--requests-per-second', str(args.requests_per_second)]
+    if args.fallback:
+        extra_args += ['--fallback', args.fallback]
+    mismatches = []
+    try:
+        stays = os.path.join(workdir, 'stays.csv')
+        generate_stays(stays, args.rows, args.utah_fraction, args.zip_cardinality, seed=args.seed)
+        expected = None
+        for engine in args.engines:
+            perdiems, report = run_engine(engine, stays, workdir, server.url, extra_args)
+            skipped = {name: count for name, count in report['counters'].items() if name.startswith('skipped.')}
+            print('{:<12}{:>8} rows  skipped {}'.format(engine, len(perdiems), skipped or 'none'))
+            if expected is None:
+                expected = perdiems
+            elif perdiems != expected:
+                mismatches.append(engine)
+                differing = sorted(set(perdiems.items()) ^ set(expected.items()))
+                print('  {} differs from {}: {} rows, e.g. {}'.format(engine, args.engines[0], len(differing),
+                                                                      differing[:3]))
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that every perdiem.py engine writes the same results.')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--utah-fraction', type=float, default=0.3)
+    parser.add_argument('--zip-cardinality', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument('--latency', type=float, default=0.005, help='stub GSA latency in seconds')
+    parser.add_argument('--empty-rate', type=float, default=0.1, help='share of zips the stub has no rates for')
+    parser.add_argument('--fallback', choices=['standard', 'state'], default='standard')
+    parser.add_argument('--requests-per-second', type=float, default=500.0)
+    args = parser.parse_args()
+    sys.exit(1 if check_engines(args) else 0)
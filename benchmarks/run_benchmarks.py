@@ -0,0 +1,175 @@
+"""
+Benchmark the stays pipeline against synthetic stays and the stub GSA API.
+Each stage runs in a fresh process so peak RSS is per stage. Results can be saved and compared to catch regressions.
+
+    python benchmarks/run_benchmarks.py --rows 100000 --zip-cardinality 2000 --latency 0.02 --save bench.json
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPO_FOLDER = os.path.dirname(BENCHMARK_FOLDER)
+
+STAGES = ['add_perdiem_from_gsa', 'get_rate_for_stays', '_combine_result_tables', 'run_pipeline']
+
+
+def run_stage(stage, stays, workdir, rates_db, requests_per_second):
+    """Run one stage in this process and return its timing. Output goes to workdir."""
+    sys.path.insert(0, REPO_FOLDER)
+    import perdiem
+    import pipeline
+    import utah_perdiem
+
+    perdiem.GSA_RATE_LIMITER.set_rate(requests_per_second)
+    perdiem.open_rate_cache(rates_db)
+    utah_rates_csv = os.path.join(REPO_FOLDER, 'utah_rates.csv')
+    non_utah_csv = os.path.join(workdir, 'non_utah.csv')
+    utah_csv = os.path.join(workdir, 'utah.csv')
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if stage == 'add_perdiem_from_gsa':
+            perdiem.add_perdiem_from_gsa(stays, non_utah_csv)
+        elif stage == 'get_rate_for_stays':
+            utah_perdiem.get_rate_for_stays(utah_perdiem.create_rate_areas(utah_rates_csv), stays, utah_csv)
+        elif stage == '_combine_result_tables':
+            perdiem._combine_result_tables(workdir, [non_utah_csv, utah_csv], os.path.join(workdir, 'combined.csv'))
+        elif stage == 'run_pipeline':
+            pipeline.run_pipeline(stays, utah_perdiem.create_rate_areas(utah_rates_csv),
+                                  os.path.join(workdir, 'pipeline.csv'))
+    return {'seconds': time.perf_counter() - start,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+
+def count_stays(stays):
+    """(total, non-Utah) stay counts."""
+    import csv
+    total = non_utah = 0
+    with open(stays, 'r') as stays_file:
+        for row in csv.DictReader(stays_file):
+            total += 1
+            non_utah += row['STATE'].strip() != 'UT'
+    return total, non_utah
+
+
+def run_benchmarks(args):
+    sys.path.insert(0, BENCHMARK_FOLDER)
+    from stub_gsa_server import StubGsaServer
+    from synthetic_stays import generate_stays
+
+    workdir = tempfile.mkdtemp(prefix='perdiem_bench_')
+    try:
+        stays = args.stays
+        if stays is None:
+            stays = os.path.join(workdir, 'stays.csv')
+            generate_stays(stays, args.rows, args.utah_fraction, args.zip_cardinality, seed=args.seed)
+        total_rows, non_utah_rows = count_stays(stays)
+
+        initial_db = os.path.join(workdir, 'initial_rates.sqlite')
+        if args.warm_cache:
+            sys.path.insert(0, REPO_FOLDER)
+            from rate_cache import RateCache
+            cache = RateCache(initial_db)
+            for json_path in sorted(glob.glob(os.path.join(REPO_FOLDER, 'gsa_destination_rates', 'rates_*.json'))):
+                cache.import_json(json_path)
+            cache.close()
+
+        server = StubGsaServer(args.latency, args.error_rate, args.empty_rate).start()
+        env = dict(os.environ, GSA_API_URL=server.url)
+        results = {}
+        for stage in args.stages:
+            rates_db = os.path.join(workdir, 'rates_{}.sqlite'.format(stage))
+            if os.path.exists(initial_db):
+                shutil.copy(initial_db, rates_db)
+            result_json = os.path.join(workdir, '{}.json'.format(stage))
+            requests_before = server.requests
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--child', stage, '--stays', stays,
+                            '--workdir', workdir, '--rates-db', rates_db, '--result', result_json,
+                            '--requests-per-second', str(args.requests_per_second)],
+                           env=env, check=True)
+            with open(result_json, 'r') as result_file:
+                result = json.load(result_file)
+            api_calls = server.requests - requests_before
+            result['rows'] = total_rows
+            result['rows_per_second'] = total_rows / result['seconds']
+            result['api_calls'] = api_calls
+            if stage != 'get_rate_for_stays' and stage != '_combine_result_tables' and non_utah_rows:
+                # share of non-Utah stays answered without an API request, retries count as requests
+                result['cache_hit_rate'] = max(0.0, 1 - float(api_calls) / non_utah_rows)
+            results[stage] = result
+        server.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def print_results(results, baseline=None, tolerance=0.2):
+    """Print a results table. Returns the stages that are slower than baseline by more than tolerance."""
+    regressions = []
+    print('{:<24}{:>10}{:>12}{:>10}{:>12}{:>12}'.format('stage', 'seconds', 'rows/sec', 'api calls', 'cache hit',
+                                                       'peak MB'))
+    for stage, result in results.items():
+        hit_rate = result.get('cache_hit_rate')
+        line = '{:<24}{:>10.2f}{:>12.0f}{:>10}{:>12}{:>12.1f}'.format(
+            stage, result['seconds'], result['rows_per_second'], result['api_calls'],
+            '' if hit_rate is None else '{:.1%}'.format(hit_rate), result['peak_rss_mb'])
+        if baseline and stage in baseline:
+            change = result['rows_per_second'] / baseline[stage]['rows_per_second'] - 1
+            line += '{:>+10.1%}'.format(change)
+            if change < -tolerance:
+                regressions.append(stage)
+                line += '  REGRESSION'
+        print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the per diem pipeline.')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--utah-fraction', type=float, default=0.3)
+    parser.add_argument('--zip-cardinality', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stays', help='benchmark an existing stays csv instead of generating one')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--warm-cache', action='store_true',
+                        help='start every stage with gsa_destination_rates/*.json imported into the rate cache')
+    parser.add_argument('--latency', type=float, default=0.02, help='stub GSA latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of stub GSA requests that fail')
+    parser.add_argument('--empty-rate', type=float, default=0.0, help='share of zips the stub has no rates for')
+    parser.add_argument('--requests-per-second', type=float, default=50.0)
+    parser.add_argument('--save', help='write results json')
+    parser.add_argument('--compare', help='results json from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed rows/sec slowdown before failing')
+    # used when a stage runs in its own process
+    parser.add_argument('--child', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--rates-db', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        stage_result = run_stage(args.child, args.stays, args.workdir, args.rates_db, args.requests_per_second)
+        with open(args.result, 'w') as result_file:
+            json.dump(stage_result, result_file)
+        sys.exit()
+
+    benchmark_results = run_benchmarks(args)
+    baseline_results = None
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline_results = json.load(baseline_file)
+    slower_stages = print_results(benchmark_results, baseline_results, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(benchmark_results, results_file, indent=4, sort_keys=True)
+    sys.exit(1 if slower_stages else 0)
@@ -0,0 +1,119 @@
+"""Local stand in for the GSA per diem zip API with configurable latency and error rates."""
+import argparse
+import calendar
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from synthetic_stays import load_gsa_destinations
+
+ZIP_PATH = re.compile(r'.*/rates/zip/(\d{5})/year/(\d{4})$')
+
+
+def gsa_zip_response(zipcode, fiscal_year, city, state):
+    """Body shaped like the v2 zip endpoint. Rates are derived from the zip so repeated runs agree."""
+    base = 90 + zlib.crc32(zipcode.encode()) % 150
+    months = [{'value': base + (15 if number in (6, 7, 8) else 0), 'number': number,
+               'short': calendar.month_abbr[number], 'long': calendar.month_name[number]}
+              for number in range(1, 13)]
+    return {'request': None, 'errors': [], 'version': None,
+            'rates': [{'oconusInfo': None, 'state': state, 'year': int(fiscal_year), 'isOconus': 'false',
+                       'rate': [{'months': {'month': months}, 'meals': 55, 'zip': zipcode, 'county': '',
+                                 'city': city, 'standardRate': 'false'}]}]}
+
+
+class StubGsaServer(object):
+    """
+    Threaded HTTP server answering /rates/zip/<zip>/year/<fy>.
+    - latency: seconds added to every response, jittered by +/- 50%.
+    - error_rate: share of requests answered with a 503 or 429 and Retry-After: 0.
+    - empty_rate: share of zips answered with no rates.
+    """
+
+    def __init__(self, latency=0.05, error_rate=0.0, empty_rate=0.0, port=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._destinations = {zipcode: (state, city) for state, city, zipcode in load_gsa_destinations()}
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/travel/perdiem/v2'.format(self._server.server_port)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                    failure = stub._random.random() < stub.error_rate
+                    if failure:
+                        stub.errors += 1
+                time.sleep(stub.latency * (0.5 + random.random()))
+                match = ZIP_PATH.match(self.path)
+                if failure:
+                    self._send(self._failure_status(), b'{}', {'Retry-After': '0'})
+                elif match is None:
+                    self._send(404, b'{}')
+                else:
+                    zipcode, fiscal_year = match.groups()
+                    state, city = stub._destinations.get(zipcode, ('', 'Synthetic'))
+                    body = gsa_zip_response(zipcode, fiscal_year, city, state)
+                    if zlib.crc32(zipcode.encode()) % 1000 < stub.empty_rate * 1000:
+                        body['rates'] = []
+                    self._send(200, json.dumps(body).encode())
+
+            def _failure_status(self):
+                return 503 if random.random() < 0.5 else 429
+
+            def _send(self, status, body, headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a stub GSA per diem API.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--empty-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    server = StubGsaServer(args.latency, args.error_rate, args.empty_rate, args.port)
+    print('Stub GSA API at {}'.format(server.url))
+    server.serve_forever()
@@ -0,0 +1,87 @@
+"""Generate synthetic stay csvs shaped like the State Travel quarterly export."""
+import argparse
+import csv
+import glob
+import json
+import os
+import random
+from datetime import date, timedelta
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Column letters matter: the Sheets formulas in perdiem.SHEETS_FORMULAS use Q, R, S and T.
+FIELDS = ['ROW_ID', 'TRAVELER_ID', 'AGENCY', 'DIVISION', 'TRIP_ID', 'HOTEL_NAME', 'ADDRESS', 'CITY', 'STATE',
+          'ZIP_CODE', 'COUNTRY', 'CHECKIN_DATE', 'CHECKOUT_DATE', 'BOOKING_DATE', 'PAYMENT_TYPE', 'ROOM_TYPE',
+          'NIGHTS', 'NIGHTLY_RATE', 'PERDIEM', 'OVER_PERDIEM', 'PERCENT_OVER', 'TOTAL_OVER', 'QUARTER', 'NOTES']
+
+
+def load_gsa_destinations(rates_folder=os.path.join(REPO_FOLDER, 'gsa_destination_rates')):
+    """(state, city, zipcode) for every cached GSA destination."""
+    destinations = set()
+    for json_path in glob.glob(os.path.join(rates_folder, 'rates_*.json')):
+        with open(json_path, 'r') as json_file:
+            for rate_key, record in json.load(json_file).items():
+                fiscal_year, zipcode, state = rate_key.split(':')
+                destinations.add((state, record['city'], zipcode))
+    return sorted(destinations)
+
+
+def load_utah_cities(utah_rates_csv=os.path.join(REPO_FOLDER, 'utah_rates.csv')):
+    with open(utah_rates_csv, 'r') as rates:
+        return sorted({row['CITY'] for row in csv.DictReader(rates) if row['STATE'] == 'UT'})
+
+
+def generate_stays(output_csv, rows, utah_fraction=0.3, zip_cardinality=None, start=date(2019, 10, 1), days=365,
+                   bad_date_fraction=0.0005, seed=0):
+    """
+    Write a synthetic stays csv.
+    - utah_fraction: share of stays in Utah.
+    - zip_cardinality: number of distinct non-Utah zips. Beyond the cached destinations, made up zips are added
+      which the cache and stub server have not seen.
+    """
+    rng = random.Random(seed)
+    destinations = load_gsa_destinations()
+    if zip_cardinality is not None:
+        if zip_cardinality <= len(destinations):
+            destinations = rng.sample(destinations, zip_cardinality)
+        else:
+            states = sorted({state for state, city, zipcode in destinations})
+            destinations += [(rng.choice(states), 'Synthetic {}'.format(i), '{:05d}'.format(90000 + i % 9999))
+                             for i in range(zip_cardinality - len(destinations))]
+    utah_cities = load_utah_cities()
+    utah_cities += [city.upper() for city in utah_cities[:10]] + ['Salt Lake', 'Cedar', 'St George']
+
+    with open(output_csv, 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(FIELDS)
+        for row_id in range(1, rows + 1):
+            checkin = start + timedelta(days=rng.randrange(days))
+            nights = rng.randint(1, 5)
+            if rng.random() < utah_fraction:
+                state, city, zipcode = 'UT', rng.choice(utah_cities), '84{:03d}'.format(rng.randrange(1000))
+            else:
+                state, city, zipcode = rng.choice(destinations)
+                if rng.random() < 0.1:
+                    zipcode += '-{:04d}'.format(rng.randrange(10000))
+            checkin_date = '{}/{}/{}'.format(checkin.month, checkin.day, checkin.year)
+            if rng.random() < bad_date_fraction:
+                checkin_date = 'TBD'
+            checkout = checkin + timedelta(days=nights)
+            writer.writerow([row_id, '00{:05d}'.format(rng.randrange(100000)), 'AGENCY {}'.format(rng.randrange(40)),
+                             'DIV {}'.format(rng.randrange(10)), 'T{:07d}'.format(row_id), 'Hotel {}'.format(city),
+                             '{} Main St'.format(rng.randrange(1, 9999)), city, state, zipcode, 'US',
+                             checkin_date, checkout.strftime('%m/%d/%Y'), checkin.strftime('%m/%d/%Y'),
+                             rng.choice(['P-CARD', 'TRAVEL CARD', 'DIRECT BILL']),
+                             rng.choice(['KING', 'QUEEN', 'DOUBLE']), nights, rng.randint(60, 320),
+                             '', '', '', '', 'Q3', rng.choice(['', '', 'conference, "late" checkin'])])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic stays csv.')
+    parser.add_argument('output_csv')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--utah-fraction', type=float, default=0.3)
+    parser.add_argument('--zip-cardinality', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_stays(args.output_csv, args.rows, args.utah_fraction, args.zip_cardinality, seed=args.seed)
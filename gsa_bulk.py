@@ -0,0 +1,146 @@
+"""Offline index built from the GSA per fiscal year bulk rate tables."""
+import calendar
+import csv
+import json
+import os
+import re
+
+GSA_MONTHS = list(calendar.month_abbr)[1:]
+
+# Column names used by the different GSA downloads, compared after normalize_column.
+DESTINATION_ID_COLUMNS = ('did', 'destinationid', 'destid', 'id')
+ZIP_COLUMNS = ('zip', 'zipcode', 'zipcodes')
+STATE_COLUMNS = ('state', 'st', 'stateabbr')
+CITY_COLUMNS = ('city', 'name', 'destination', 'primarydestination')
+COUNTY_COLUMNS = ('county', 'countylocationdefined', 'locationdefined')
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]')
+
+
+def normalize_column(name):
+    return _NON_ALNUM.sub('', name.lower())
+
+
+def _find_column(fields, candidates, required=True):
+    normalized = {normalize_column(field): field for field in fields}
+    for candidate in candidates:
+        if candidate in normalized:
+            return normalized[candidate]
+    if required:
+        raise KeyError('None of the columns {} found in {}'.format(candidates, list(fields)))
+    return None
+
+
+def _read_xlsx(path):
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportError('openpyxl is required to read xlsx bulk rate files')
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    rows = workbook.active.iter_rows(values_only=True)
+    header = None
+    for row in rows:  # GSA workbooks can have title rows above the header
+        if row and sum(1 for v in row if v is not None) > 1:
+            header = ['' if v is None else str(v).strip() for v in row]
+            break
+    records = []
+    for row in rows:
+        if row is None or all(v is None for v in row):
+            continue
+        records.append({field: '' if v is None else str(v).strip() for field, v in zip(header, row)})
+    workbook.close()
+    return records
+
+
+def _flatten_months(record):
+    """API style records nest month rates under months.month."""
+    if isinstance(record.get('months'), dict):
+        record = dict(record)
+        for month in record.pop('months')['month']:
+            record[month['short']] = month['value']
+    return record
+
+
+def read_table(path):
+    """Read a bulk csv, json or xlsx file as a list of dicts."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        with open(path, 'r', newline='', encoding='utf-8-sig') as table:
+            return list(csv.DictReader(table))
+    elif extension == '.json':
+        with open(path, 'r') as table:
+            records = json.load(table)
+        if isinstance(records, dict):
+            records = records.get('rates', records.get('records', []))
+        return [_flatten_months(record) for record in records]
+    elif extension in ('.xlsx', '.xlsm'):
+        return _read_xlsx(path)
+    raise ValueError('Unsupported bulk rate file: {}'.format(path))
+
+
+def _rate_value(value):
+    return str(int(float(str(value).replace('$', '').replace(',', '').strip())))
+
+
+class BulkRateIndex(object):
+    """
+    zip -> destinations -> monthly rates for whole fiscal years.
+    Destinations are stored as GSA API style records so they can go through select_rate and decode_api_record.
+    """
+
+    def __init__(self):
+        self._zip_destinations = {}  # (fiscal_year, zip, state) -> [record, ...]
+        self._standard_records = {}  # fiscal_year -> standard rate record
+
+    def __len__(self):
+        return len(self._zip_destinations)
+
+    def ingest(self, fiscal_year, zip_path, destination_path):
+        """Add one fiscal year from a ZIP->destination table and a destination->monthly rate table."""
+        fiscal_year = str(fiscal_year)
+        destination_rows = read_table(destination_path)
+        fields = destination_rows[0].keys() if destination_rows else []
+        id_column = _find_column(fields, DESTINATION_ID_COLUMNS)
+        city_column = _find_column(fields, CITY_COLUMNS)
+        state_column = _find_column(fields, STATE_COLUMNS)
+        county_column = _find_column(fields, COUNTY_COLUMNS, required=False)
+        month_columns = {month: _find_column(fields, (month.lower(),)) for month in GSA_MONTHS}
+
+        destinations = {}
+        for row in destination_rows:
+            record = {month: _rate_value(row[column]) for month, column in month_columns.items()}
+            record.update({'City': row[city_column].strip(),
+                           'County': row[county_column].strip() if county_column else '',
+                           'State': row[state_column].strip().upper(),
+                           'DestinationID': str(row[id_column]).strip(),
+                           'FiscalYear': fiscal_year})
+            if record['City'].lower() == 'standard rate':
+                self._standard_records[fiscal_year] = dict(record, Zip='')
+            destinations.setdefault(record['DestinationID'], []).append(record)
+
+        zip_rows = read_table(zip_path)
+        fields = zip_rows[0].keys() if zip_rows else []
+        id_column = _find_column(fields, DESTINATION_ID_COLUMNS)
+        zip_column = _find_column(fields, ZIP_COLUMNS)
+        state_column = _find_column(fields, STATE_COLUMNS)
+
+        zips = 0
+        for row in zip_rows:
+            zipcode = str(row[zip_column]).strip().zfill(5)
+            state = row[state_column].strip().upper()
+            for destination in destinations.get(str(row[id_column]).strip(), []):
+                record = dict(destination, Zip=zipcode)
+                key = (fiscal_year, zipcode, state)
+                if key not in self._zip_destinations:
+                    zips += 1
+                self._zip_destinations.setdefault(key, []).append(record)
+
+        return zips
+
+    def get(self, fiscal_year, zipcode, state):
+        """All destination records for a zip or None when the bulk tables do not cover it."""
+        return self._zip_destinations.get((str(fiscal_year), zipcode, state.upper()))
+
+    def standard_record(self, fiscal_year):
+        """The standard rate record of a fiscal year or None when its destination table has no standard rate row."""
+        return self._standard_records.get(str(fiscal_year))
@@ -0,0 +1,53 @@
+"""Pooled keep-alive HTTP session for the GSA per diem API."""
+import os
+import random
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Override with GSA_API_URL to point the client at a local stub server.
+GSA_API_URL = os.environ.get('GSA_API_URL', 'https://api.gsa.gov/travel/perdiem/v2')
+GSA_API_KEY = os.environ.get('GSA_API_KEY', 'zoXm1gdyKjNAr6SIIJnd42u9ZvVbNSZvuPTmW1zV')
+
+TIMEOUT = (5, 30)  # (connect, read) seconds
+POOL_SIZE = 10  # keep-alive connections held open to GSA
+RETRIES = 4
+BACKOFF_FACTOR = 1  # retry sleeps double from this many seconds
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class JitteredRetry(Retry):
+    """urllib3 Retry that adds random jitter to the exponential backoff and honours Retry-After on 5xx."""
+    JITTER_SECONDS = 1.0
+    RETRY_AFTER_STATUS_CODES = RETRY_STATUSES
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return backoff + random.uniform(0, self.JITTER_SECONDS)
+
+
+class GsaSession(object):
+    """Shared connection pool to the GSA API with transport level retries."""
+
+    def __init__(self, base_url=GSA_API_URL, api_key=GSA_API_KEY, timeout=TIMEOUT, pool_size=POOL_SIZE,
+                 retries=RETRIES, backoff_factor=BACKOFF_FACTOR):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['x-api-key'] = api_key
+        retry = JitteredRetry(total=retries,
+                              backoff_factor=backoff_factor,
+                              status_forcelist=RETRY_STATUSES,
+                              allowed_methods=frozenset(['GET']),
+                              respect_retry_after_header=True,
+                              raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, path):
+        """GET a path relative to the API base url. Retries have already been spent on the returned response."""
+        return self.session.get(self.base_url + path, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
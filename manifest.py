@@ -0,0 +1,69 @@
+"""Checkpoint manifest of the stays already enriched into a results csv, for resumable and incremental runs."""
+import hashlib
+import sqlite3
+
+
+class RunManifest(object):
+    """
+    Record each ROW_ID written to an output csv with a digest of its input values.
+    The committed output size is stored with every checkpoint so rows written after it can be discarded on resume.
+    """
+
+    def __init__(self, db_path, output_csv):
+        self.output_csv = output_csv
+        self._pending = {}  # row_id -> digest, or None to remove, since the last checkpoint
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS enriched_rows (
+                                  output TEXT NOT NULL,
+                                  row_id TEXT NOT NULL,
+                                  digest TEXT NOT NULL,
+                                  PRIMARY KEY (output, row_id)
+                              ) WITHOUT ROWID''')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS outputs (
+                                  output TEXT PRIMARY KEY,
+                                  size INTEGER NOT NULL
+                              )''')
+        self._conn.commit()
+
+    @staticmethod
+    def row_digest(values):
+        """Digest of a stay's raw input values."""
+        return hashlib.sha1('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+    def load_digests(self):
+        """ROW_ID -> digest for every committed row of the output."""
+        rows = self._conn.execute('SELECT row_id, digest FROM enriched_rows WHERE output = ?', (self.output_csv,))
+        return dict(rows)
+
+    def committed_size(self):
+        """Size of the output csv at the last checkpoint, or None if nothing has been committed."""
+        row = self._conn.execute('SELECT size FROM outputs WHERE output = ?', (self.output_csv,)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, row_id, digest):
+        self._pending[row_id] = digest
+
+    def remove(self, row_id):
+        self._pending[row_id] = None
+
+    def checkpoint(self, output_size):
+        """Commit rows recorded since the last checkpoint along with the output size that contains them."""
+        self._conn.executemany('INSERT OR REPLACE INTO enriched_rows VALUES (?, ?, ?)',
+                               [(self.output_csv, row_id, digest)
+                                for row_id, digest in self._pending.items() if digest is not None])
+        self._conn.executemany('DELETE FROM enriched_rows WHERE output = ? AND row_id = ?',
+                               [(self.output_csv, row_id)
+                                for row_id, digest in self._pending.items() if digest is None])
+        self._conn.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?)', (self.output_csv, output_size))
+        self._conn.commit()
+        self._pending = {}
+
+    def reset(self):
+        """Forget everything recorded for the output."""
+        self._conn.execute('DELETE FROM enriched_rows WHERE output = ?', (self.output_csv,))
+        self._conn.execute('DELETE FROM outputs WHERE output = ?', (self.output_csv,))
+        self._conn.commit()
+        self._pending = {}
+
+    def close(self):
+        self._conn.close()
@@ -1,87 +1,229 @@
 """Script to add federal and Utah hotel per diems to hotel stay data."""
 import json
-import requests
 import csv
-from datetime import datetime
+from datetime import date
 import re
-import random
 import time
 import os
 import calendar
-
-RATE_LIMIT_SECONDS = (0.1, 0.2)  # average request rate to GSA will be uniformly distributed between these times
+import functools
+import glob
+import argparse
+import random
+import sys
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+
+from gsa_session import GsaSession
+from rate_cache import RateCache
+from gsa_bulk import BulkRateIndex
+from run_metrics import METRICS, profiled
+
+REQUESTS_PER_SECOND = 6.0  # sustained request rate to GSA shared by all fetch workers
+FETCH_WORKERS = 4  # concurrent GSA requests made while prefetching rates for a stays file
+MISSING_RATE_TTL = 30 * 24 * 3600  # seconds before a destination GSA had no rates for is requested again
+FALLBACK_POLICIES = ('standard', 'state')  # rates used for destinations GSA has no rates for
 
 ZIP_PLUS4_MATCHER = re.compile(r'\d{5}($|(-\d{4}))')
 
 RATE_DATE_FORMAT = '%Y-%m'
 
-FEDERAL_FISCAL_YEARS = {  # add new fiscal years in the future.
-    '2020': (datetime.strptime('10/01/2019', '%m/%d/%Y'), datetime.strptime('9/30/2020', '%m/%d/%Y')),
-    '2019': (datetime.strptime('10/01/2018', '%m/%d/%Y'), datetime.strptime('9/30/2019', '%m/%d/%Y')),
-    '2018': (datetime.strptime('10/01/2017', '%m/%d/%Y'), datetime.strptime('9/30/2018', '%m/%d/%Y')),
-    '2017': (datetime.strptime('10/01/2016', '%m/%d/%Y'), datetime.strptime('9/30/2017', '%m/%d/%Y')),
-    '2016': (datetime.strptime('10/01/2015', '%m/%d/%Y'), datetime.strptime('9/30/2016', '%m/%d/%Y')),
-    '2015': (datetime.strptime('10/01/2014', '%m/%d/%Y'), datetime.strptime('9/30/2015', '%m/%d/%Y'))
-}
+CHECKIN_MATCHER = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})$')  # same dates datetime.strptime accepts for %m/%d/%Y
+
+FISCAL_YEAR_START_MONTH = 10  # federal fiscal years begin October 1st of the previous calendar year
 
 GSA_MONTHS = list(calendar.month_abbr)[1:]
+MONTH_NUMBERS = {month_abbr: number for number, month_abbr in enumerate(GSA_MONTHS, 1)}
+FISCAL_MONTHS = GSA_MONTHS[FISCAL_YEAR_START_MONTH - 1:] + GSA_MONTHS[:FISCAL_YEAR_START_MONTH - 1]  # Oct is 0
 
 DEFAULT_GSA_RECORDS = {  # This is the standard GSA rate and may change each fiscal year.
     '2020': {'City': 'Standard Rate', 'Dec': '94', 'Feb': '94', 'Zip': '82930', 'Aug': '94', 'Sep': '94', 'Apr': '94', 'Jun': '94', 'State': 'UT', 'Jul': '94', 'Meals': '55', 'County': '', 'May': '94', 'DestinationID': '0', 'Mar': '94', 'Jan': '94', 'LocationDefined': '', 'Nov': '94', '_id': 59374, 'Oct': '94', 'FiscalYear': '2020'}
 }
 
 
+@functools.lru_cache(maxsize=None)
 def fiscal_year_month_convertor(fiscal_year, month_abbr):
     """Convert federal fiscal year and 3 letter month to YYYY-MM format."""
-    year_adjust = None
-    if month_abbr in ['Oct', 'Nov', 'Dec']:
-        year_adjust = -1
-    else:
-        year_adjust = 0
-    adjusted_year = int(fiscal_year) + year_adjust
-    converted_ratedate = datetime.strftime(datetime.strptime('{}-{}'.format(adjusted_year, month_abbr), '%Y-%b'),
-                                           RATE_DATE_FORMAT)
-    return converted_ratedate
-
-
-def api_retry(api_call):
-    """Retry and api call if calling method returns None."""
-    def retry(*args, **kwargs):
-        response = api_call(*args, **kwargs)
-        back_off = 1
-        while response is None and back_off <= 8:
-            time.sleep(back_off + random.random())
-            response = api_call(*args, **kwargs)
-            back_off += back_off
-        return response
-    return retry
+    month = MONTH_NUMBERS[month_abbr]
+    year = int(fiscal_year) - 1 if month >= FISCAL_YEAR_START_MONTH else int(fiscal_year)
+    return '{:04d}-{:02d}'.format(year, month)
+
+
+def fiscal_month_index(month):
+    """Index of a calendar month number in its fiscal year, October is 0."""
+    return (month - FISCAL_YEAR_START_MONTH) % 12
+
+
+@functools.lru_cache(maxsize=8192)
+def resolve_checkin(month_day_year):
+    """
+    Parse a M/D/YYYY check-in date once and return its federal fiscal year and fiscal month index.
+    Raises ValueError for a bad date."""
+    match = CHECKIN_MATCHER.match(month_day_year)
+    if match is None:
+        raise ValueError('Bad check-in date: {}'.format(month_day_year))
+    month, day, year = (int(part) for part in match.groups())
+    date(year, month, day)  # validate the day of month
+    fiscal_year = year + 1 if month >= FISCAL_YEAR_START_MONTH else year
+    return sys.intern(str(fiscal_year)), fiscal_month_index(month)
+
+
+_STALE_DEFAULT_YEARS = set()  # fiscal years already warned about using an older standard rate
+
+
+def get_default_record(fiscal_year, bulk_rates=None, metrics=METRICS):
+    """
+    Standard GSA rate record for a fiscal year, from DEFAULT_GSA_RECORDS or the bulk rate tables.
+    A year in neither gets the latest known standard rate, labelled with the year it is from, a one time warning and
+    a gsa.stale_default_records count.
+    """
+    if fiscal_year in DEFAULT_GSA_RECORDS:
+        return DEFAULT_GSA_RECORDS[fiscal_year]
+    standard_record = bulk_rates.standard_record(fiscal_year) if bulk_rates is not None else None
+    if standard_record is not None:
+        return standard_record
+    latest_year = max(DEFAULT_GSA_RECORDS)
+    metrics.incr('gsa.stale_default_records')
+    if fiscal_year not in _STALE_DEFAULT_YEARS:
+        _STALE_DEFAULT_YEARS.add(fiscal_year)
+        print('No standard GSA rate for fiscal year {}, using the fiscal year {} rate. Add it to DEFAULT_GSA_RECORDS '
+              'or load the bulk tables with --bulk'.format(fiscal_year, latest_year))
+    latest_record = DEFAULT_GSA_RECORDS[latest_year]
+    return dict(latest_record, City='{} (FY{})'.format(latest_record['City'], latest_year), FiscalYear=fiscal_year)
+
+
+class TokenBucket(object):
+    """Thread safe token bucket rate limiter shared by every GSA request."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = self._positive_rate(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """Change the sustained requests per second."""
+        rate = self._positive_rate(rate)
+        with self._lock:
+            self.rate = rate
+
+    @staticmethod
+    def _positive_rate(rate):
+        rate = float(rate)
+        if not rate > 0:
+            raise ValueError('Requests per second must be positive: {}'.format(rate))
+        return rate
+
+    def try_acquire(self):
+        """Take a token without blocking. Returns 0 when a request is allowed, otherwise seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Block until a request is allowed. Returns seconds spent waiting."""
+        waited = 0.0
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+def positive_float(value):
+    """argparse type for rates and other values that must be above 0."""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a number: {}'.format(value))
+    if not number > 0:
+        raise argparse.ArgumentTypeError('must be positive: {}'.format(value))
+    return number
+
+
+GSA_RATE_LIMITER = TokenBucket(REQUESTS_PER_SECOND)
+GSA_SESSION = GsaSession()
+RATE_CACHE_DB = 'gsa_destination_rates/rates.sqlite'
+
+
+def configure_gsa_session(**session_args):
+    """Replace the shared GSA session, e.g. to resize the pool or point at a stub server."""
+    global GSA_SESSION
+    GSA_SESSION.close()
+    GSA_SESSION = GsaSession(**session_args)
+    return GSA_SESSION
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class NoGsaRates(Exception):
+    """GSA has no rates for a destination, an empty response or a 400/404 for the zip."""
 
 
 class Gsa_Destination_Rate(object):
-    """Store rate information from a GSA defined location."""
-    request_key_rates = {}
+    """
+    Store rate information from a GSA defined location.
+    The 12 monthly rates are held in an array in fiscal month order, October first.
+    """
+    __slots__ = ('city', 'county', 'state', 'zipcode', 'destination_id', 'fiscal_year', 'monthly_rates',
+                 'request_key')
 
     def __init__(self, city, county, state, zipcode, destination_id, fiscal_year, rates, request_key=None):
-        """ctor."""
+        """
+        ctor.
+        rates: {'YYYY-MM': rate} as stored in the json and sqlite caches, or 12 rates in fiscal month order."""
         self.city = city
-        self.county = county
-        self.state = state
+        self.county = _intern(county)
+        self.state = _intern(state)
         self.zipcode = zipcode
         self.destination_id = destination_id
-        self.rates = rates
-        self.fiscal_year = fiscal_year
+        self.fiscal_year = _intern(fiscal_year)
+        if isinstance(rates, dict):
+            monthly_rates = [None] * 12
+            for rate_date, rate in rates.items():
+                monthly_rates[fiscal_month_index(int(rate_date[5:7]))] = int(rate)
+            if None in monthly_rates:
+                raise ValueError('Missing monthly rates for {} {}: {}'.format(zipcode, fiscal_year, sorted(rates)))
+            rates = monthly_rates
+        self.monthly_rates = array('H', rates)
         if request_key is None:
-            self.request_key = get_rate_key(fiscal_year, zipcode, state)
-        else:
-            self.request_key = request_key
-        Gsa_Destination_Rate.request_key_rates[self.request_key] = self
+            request_key = get_rate_key(fiscal_year, zipcode, state)
+        self.request_key = sys.intern(request_key)
+
+    def get_rate(self, fiscal_month):
+        """Rate for a fiscal month index from resolve_checkin."""
+        return self.monthly_rates[fiscal_month]
+
+    @property
+    def rates(self):
+        """{'YYYY-MM': rate} for the fiscal year."""
+        return {fiscal_year_month_convertor(self.fiscal_year, month_abbr): rate
+                for month_abbr, rate in zip(FISCAL_MONTHS, self.monthly_rates)}
 
     @staticmethod
     def encode_destination(destination):
         """Encode a Gsa_Destination_Rate to json."""
         if isinstance(destination, Gsa_Destination_Rate):
-            field_dict = destination.__dict__
-            return field_dict
+            return {'city': destination.city,
+                    'county': destination.county,
+                    'state': destination.state,
+                    'zipcode': destination.zipcode,
+                    'destination_id': destination.destination_id,
+                    'rates': destination.rates,
+                    'fiscal_year': destination.fiscal_year,
+                    'request_key': destination.request_key}
         else:
             type_name = destination.__class__.__name__
             raise TypeError('Object of type {} is not JSON serializable'.format(type_name))
@@ -90,7 +232,7 @@ class Gsa_Destination_Rate(object):
     def decode_api_record(record):
         """Decode GSA rates from API response record."""
         fiscal_year = record['FiscalYear']
-        rates = {fiscal_year_month_convertor(fiscal_year, key): int(record[key]) for key in record if key in GSA_MONTHS}
+        rates = [int(record[month_abbr]) for month_abbr in FISCAL_MONTHS]
         gsa_rate = Gsa_Destination_Rate(record['City'],
                                         record['County'],
                                         record['State'],
@@ -102,20 +244,41 @@ class Gsa_Destination_Rate(object):
         return gsa_rate
 
 
-def save_tables(destination_rates, json_path):
-    """Cache rates for a destination as they are returned from the GSA API."""
-    with open(json_path, 'w') as f_out:
-        f_out.write(json.dumps(destination_rates, sort_keys=True, indent=4, default=Gsa_Destination_Rate.encode_destination))
+class RateMemory(object):
+    """Thread safe in-memory tier of destination rates. Least recently used rates are dropped past maxsize."""
 
+    def __init__(self, maxsize=None):
+        """maxsize: most rates held, None for no limit."""
+        self.maxsize = maxsize
+        self._rates = OrderedDict()
+        self._lock = threading.Lock()
 
-def load_tables(json_path):
-    with open(json_path, 'r') as json_file:
-        key_rates = json.load(json_file)
+    def get(self, rate_key):
+        with self._lock:
+            destination = self._rates.get(rate_key)
+            if destination is not None and self.maxsize is not None:
+                self._rates.move_to_end(rate_key)
+            return destination
 
-    for key_rate in key_rates.values():
-        Gsa_Destination_Rate(**key_rate)
+    def put(self, rate_key, destination):
+        with self._lock:
+            self._rates[rate_key] = destination
+            if self.maxsize is not None:
+                self._rates.move_to_end(rate_key)
+                while len(self._rates) > self.maxsize:
+                    self._rates.popitem(last=False)
 
-    return Gsa_Destination_Rate.request_key_rates
+    def __contains__(self, rate_key):
+        with self._lock:
+            return rate_key in self._rates
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rates)
+
+    def clear(self):
+        with self._lock:
+            self._rates.clear()
 
 
 def get_rate_key(fiscal_year, zipcode, state):
@@ -145,23 +308,33 @@ def select_rate(records, city):   #def select_rate(records, city)
     return selected_record
 
 
-@api_retry
-def request_gsa_destination(state, city, zipcode, fiscal_year):
+def request_gsa_destination(state, city, zipcode, fiscal_year, session=None, metrics=METRICS):
     """
     Make a request to the GSA API.
+    Connection reuse, timeouts and retries on 429/5xx are handled by the session, GSA_SESSION by default.
     GSA API doc: https://www.gsa.gov/technology/government-it-initiatives/digital-strategy/per-diem-apis/per-diem-api
     """
-    gsa_url = f'https://api.gsa.gov/travel/perdiem/v2/rates/zip/{zipcode}/year/{fiscal_year}'     #old url"https://inventory.data.gov/api/action/datastore_search"
-    headers = {'x-api-key':'zoXm1gdyKjNAr6SIIJnd42u9ZvVbNSZvuPTmW1zV'}
-
-    r = requests.get(gsa_url, headers=headers)
-    if r.status_code >= 500:
-        return None
-    elif r.status_code >= 400 and r.status_code < 500:
+    session = GSA_SESSION if session is None else session
+    metrics.incr('gsa.api_requests')
+    start = time.perf_counter()
+    try:
+        r = session.get(f'/rates/zip/{zipcode}/year/{fiscal_year}')
+    except Exception:
+        metrics.incr('gsa.api_errors')
+        raise
+    finally:
+        metrics.observe('gsa.api_seconds', time.perf_counter() - start)
+    if r.raw is not None and r.raw.retries is not None and r.raw.retries.history:
+        metrics.incr('gsa.api_retries', len(r.raw.retries.history))
+    if r.status_code >= 400:
+        metrics.incr('gsa.api_errors')
         msg = 'Bad response from GSA API: url: {} code: {}'.format(r.url, r.status_code)
+        if r.status_code in (400, 404):
+            raise NoGsaRates(msg)
         raise Exception(msg)
     return r.json()
 
+
 def modify_gsa_response(gsa_records_raw, state, city, zipcode, fiscal_year):
     modified_gsa = {}
 
@@ -175,46 +348,226 @@ def modify_gsa_response(gsa_records_raw, state, city, zipcode, fiscal_year):
     modified_gsa['County'] = ''
     return modified_gsa
 
-def get_destination_rate(state, city, zipcode, fiscal_year):
-    """Get GSA rates for a destination."""
-    rate_key = get_rate_key(fiscal_year, zipcode, state)
-    if rate_key in Gsa_Destination_Rate.request_key_rates:
-        return Gsa_Destination_Rate.request_key_rates[rate_key]
 
-    time.sleep(random.uniform(RATE_LIMIT_SECONDS[0], RATE_LIMIT_SECONDS[1]))
-    gsa_response = request_gsa_destination(state, city, zipcode, fiscal_year)
-
-    if 'rates' not in gsa_response:
-        print('rates not in dct')
-        msg = 'Bad GSA response for params: {}'.format([state, city, zipcode, fiscal_year])
-        raise Exception(msg)
-    if len(gsa_response['rates']) < 1:
-        print('no rates returned')
-        msg = f'No GSA rates returned: {zipcode} {fiscal_year}'
-        raise Exception(msg)
-    records_raw = gsa_response['rates'][0]['rate'][0]['months']['month']
-    records = [modify_gsa_response(records_raw, state, city, zipcode, fiscal_year)]
+class GsaRateProvider(object):
+    """
+    GSA destination rates for a run or a long lived service.
+    Lookups try the in-memory tier, the persistent rate_cache, the bulk_rates tables and then the GSA API.
+    - memory_size: most rates held in memory, None for no limit. Dropped rates are reloaded from rate_cache.
+    - session, limiter: default to this module's GSA_SESSION and GSA_RATE_LIMITER, shared by every provider.
+    - fallback: rates for destinations GSA has no rates for. 'standard' is the standard GSA rate, 'state' the most
+      common rates cached for the state's destinations that year. None raises NoGsaRates so the stay is skipped.
+    - missing_ttl: seconds a destination without rates is remembered before it is requested again.
+    """
 
-    selected_record = select_rate(records, city)
-    if selected_record is None:
-        selected_record = DEFAULT_GSA_RECORDS[fiscal_year]
-        print('Using default record for: ', [state, city, zipcode, fiscal_year])
+    def __init__(self, rate_cache=None, bulk_rates=None, memory_size=None, session=None, limiter=None,
+                 metrics=METRICS, fallback=None, missing_ttl=MISSING_RATE_TTL):
+        if fallback is not None and fallback not in FALLBACK_POLICIES:
+            raise ValueError('Unknown fallback policy: {}'.format(fallback))
+        self.rate_cache = rate_cache
+        self.bulk_rates = BulkRateIndex() if bulk_rates is None else bulk_rates
+        self.memory = RateMemory(memory_size)
+        self.session = session
+        self.limiter = limiter
+        self.metrics = metrics
+        self.fallback = fallback
+        self.missing_ttl = missing_ttl
+        self.missing = {}  # rate_key -> time GSA was found to have no rates
+        self._fallbacks = {}  # (fiscal_year, state) -> fallback Gsa_Destination_Rate
+
+    def _load_cached(self, rate_key):
+        if self.rate_cache is None:
+            return None
+        record = self.rate_cache.get(rate_key)
+        if record is None:
+            return None
+        record['request_key'] = rate_key
+        destination = Gsa_Destination_Rate(**record)
+        self.memory.put(rate_key, destination)
+        return destination
+
+    def get_cached_rate(self, rate_key):
+        """Get a destination rate from memory or the persistent cache without calling the API."""
+        destination = self.memory.get(rate_key)
+        if destination is not None:
+            return destination
+        return self._load_cached(rate_key)
+
+    def is_missing(self, rate_key):
+        """True when GSA had no rates for the key within missing_ttl."""
+        checked = self.missing.get(rate_key)
+        if checked is None and self.rate_cache is not None:
+            missing = self.rate_cache.get_missing(rate_key)
+            if missing is not None:
+                checked = self.missing[rate_key] = missing[1]
+        return checked is not None and time.time() - checked <= self.missing_ttl
+
+    def record_missing(self, rate_key, reason):
+        """Remember a key GSA has no rates for so it costs one request per missing_ttl. reason: NoGsaRates message."""
+        self.missing[rate_key] = time.time()
+        if self.rate_cache is not None:
+            self.rate_cache.put_missing(rate_key, reason)
+
+    def fallback_rate(self, state, fiscal_year):
+        """Rates under the fallback policy for a destination GSA has no rates for, or None without a policy."""
+        if self.fallback is None:
+            return None
+        self.metrics.incr('gsa.fallback_rates')
+        fallback_key = (fiscal_year, state.upper())
+        destination = self._fallbacks.get(fallback_key)
+        if destination is not None:
+            return destination
+
+        rates = None
+        if self.fallback == 'state' and self.rate_cache is not None:
+            state_rates = Counter(
+                tuple(Gsa_Destination_Rate(**record).monthly_rates)
+                for record in self.rate_cache.records(fiscal_year, state))
+            if state_rates:
+                rates = list(state_rates.most_common(1)[0][0])
+        if rates is None:
+            default_record = get_default_record(fiscal_year, self.bulk_rates, self.metrics)
+            rates = Gsa_Destination_Rate.decode_api_record(default_record).monthly_rates
+        destination = Gsa_Destination_Rate('{} Fallback Rate'.format(self.fallback.title()), '', state.upper(), '',
+                                           '', fiscal_year, rates, get_rate_key(fiscal_year, '', state))
+        self._fallbacks[fallback_key] = destination
+        return destination
+
+    def get_local_rate(self, state, city, zipcode, fiscal_year):
+        """
+        Get GSA rates from the caches or bulk rate tables without calling the API.
+        Destinations GSA has no rates for get the fallback rate, or None without a fallback policy.
+        """
+        rate_key = get_rate_key(fiscal_year, zipcode, state)
+        destination = self.memory.get(rate_key)
+        if destination is not None:
+            self.metrics.incr('cache.memory_hits')
+            return destination
+        if rate_key in self.missing and self.is_missing(rate_key):
+            self.metrics.incr('cache.missing_hits')
+            return self.fallback_rate(state, fiscal_year)
+        destination = self._load_cached(rate_key)
+        if destination is not None:
+            self.metrics.incr('cache.db_hits')
+            return destination
+
+        bulk_records = self.bulk_rates.get(fiscal_year, zipcode, state)
+        if bulk_records:
+            self.metrics.incr('cache.bulk_hits')
+            destination = Gsa_Destination_Rate.decode_api_record(select_rate(bulk_records, city))
+            destination.request_key = rate_key
+            self.memory.put(rate_key, destination)
+            return destination
+
+        if rate_key not in self.missing and self.is_missing(rate_key):
+            self.metrics.incr('cache.missing_hits')
+            return self.fallback_rate(state, fiscal_year)
+        return None
 
-    table_record = Gsa_Destination_Rate.decode_api_record(selected_record)
-    table_record.request_key = rate_key
-    return table_record
+    def get_destination_rate(self, state, city, zipcode, fiscal_year):
+        """Get GSA rates for a destination. Raises NoGsaRates when GSA has none and there is no fallback policy."""
+        local_rate = self.get_local_rate(state, city, zipcode, fiscal_year)
+        if local_rate is not None:
+            return local_rate
+        rate_key = get_rate_key(fiscal_year, zipcode, state)
+        if self.is_missing(rate_key):
+            raise NoGsaRates('No GSA rates for: {} {}'.format(zipcode, fiscal_year))
+
+        self.metrics.incr('cache.misses')
+        limiter = GSA_RATE_LIMITER if self.limiter is None else self.limiter
+        self.metrics.observe('gsa.limiter_wait_seconds', limiter.acquire())
+        try:
+            gsa_response = request_gsa_destination(state, city, zipcode, fiscal_year, self.session, self.metrics)
+            return self.store_response(state, city, zipcode, fiscal_year, gsa_response)
+        except NoGsaRates as e:
+            self.record_missing(rate_key, str(e))
+            fallback_rate = self.fallback_rate(state, fiscal_year)
+            if fallback_rate is None:
+                raise
+            return fallback_rate
+
+    def store_response(self, state, city, zipcode, fiscal_year, gsa_response):
+        """
+        Select, cache and return the destination rate in a GSA zip response.
+        Raises NoGsaRates when the response has no rates.
+        """
+        rate_key = get_rate_key(fiscal_year, zipcode, state)
+        if 'rates' not in gsa_response:
+            print('rates not in dct')
+            msg = 'Bad GSA response for params: {}'.format([state, city, zipcode, fiscal_year])
+            raise NoGsaRates(msg)
+        if len(gsa_response['rates']) < 1:
+            print('no rates returned')
+            self.metrics.incr('gsa.no_rates')
+            msg = f'No GSA rates returned: {zipcode} {fiscal_year}'
+            raise NoGsaRates(msg)
+        records_raw = gsa_response['rates'][0]['rate'][0]['months']['month']
+        records = [modify_gsa_response(records_raw, state, city, zipcode, fiscal_year)]
+
+        selected_record = select_rate(records, city)
+        if selected_record is None:
+            selected_record = get_default_record(fiscal_year, self.bulk_rates, self.metrics)
+            print('Using default record for: ', [state, city, zipcode, fiscal_year])
+            self.metrics.incr('gsa.default_records')
+
+        table_record = Gsa_Destination_Rate.decode_api_record(selected_record)
+        table_record.request_key = rate_key
+        self.memory.put(rate_key, table_record)
+        if self.rate_cache is not None:
+            self.rate_cache.put(rate_key, Gsa_Destination_Rate.encode_destination(table_record))
+        return table_record
+
+    def prefetch(self, rate_requests, workers=FETCH_WORKERS):
+        """
+        Resolve uncached GSA rates concurrently.
+        Requests share the rate limiter so the pool never exceeds the configured request rate.
+        Failed requests are reported and left for the row pass to handle. Known missing destinations are skipped.
+        Destinations GSA has no rates for are remembered as missing and counted apart from failures.
+        """
+        misses = [request for key, request in rate_requests.items()
+                  if self.get_cached_rate(key) is None and not self.is_missing(key)]
+        if not misses:
+            return
+
+        no_rates = failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.get_destination_rate, *request) for request in misses]
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except NoGsaRates as e:
+                    print(e)
+                    no_rates += 1
+                except Exception as e:
+                    print(e)
+                    failed += 1
+        print('Prefetched {} of {} uncached GSA rates, {} without GSA rates, {} failed'.format(
+            len(misses) - no_rates - failed, len(misses), no_rates, failed))
+
+
+GSA_RATES = GsaRateProvider()  # default provider when none is passed in
+
+
+def open_rate_cache(db_path, legacy_json=(), rates=None):
+    """
+    Use a persistent RateCache behind a GsaRateProvider, GSA_RATES by default.
+    legacy_json files are imported once when the cache database is first created.
+    """
+    is_new = not os.path.exists(db_path)
+    rate_cache = RateCache(db_path)
+    if is_new:
+        for json_path in legacy_json:
+            print('Imported {} rates from {}'.format(rate_cache.import_json(json_path), json_path))
+    (GSA_RATES if rates is None else rates).rate_cache = rate_cache
 
+    return rate_cache
 
-def get_fiscal_year(month_day_year):
-    """Given a date return it's federal fiscal year."""
-    date = datetime.strptime(month_day_year, '%m/%d/%Y')
-    for year in FEDERAL_FISCAL_YEARS:
-        start = FEDERAL_FISCAL_YEARS[year][0]
-        end = FEDERAL_FISCAL_YEARS[year][1]
-        if date >= start and date <= end:
-            return year
 
-    return None
+def load_bulk_rates(fiscal_year, zip_path, destination_path, rates=None):
+    """Ingest GSA bulk ZIP and destination rate tables so a GsaRateProvider can answer offline."""
+    zips = (GSA_RATES if rates is None else rates).bulk_rates.ingest(fiscal_year, zip_path, destination_path)
+    print('Loaded {} bulk GSA zip codes for fiscal year {}'.format(zips, fiscal_year))
+    return zips
 
 
 def lookup_state(state):
@@ -281,10 +634,131 @@ def lookup_state(state):
     return state_codes[state]
 
 
-def add_perdiem_from_gsa(data, output_csv):
-    """Add GSA perdiem to hotel stays for non-Utah data."""
-    date_string = '%m/%d/%Y'
-    with open(data, 'r') as stays, open(output_csv, 'w', newline='') as output:
+def parse_gsa_stay(row):
+    """
+    Get the GSA request parts of a stay row: (state, city, zipcode, fiscal_year, fiscal_month).
+    Raises ValueError for a bad check-in date."""
+    state, city, zipcode, checkin_date = (row['STATE'].strip(),
+                                          row['CITY'].strip(),
+                                          row['ZIP_CODE'].strip(),
+                                          row['CHECKIN_DATE'].strip())
+    fiscal_year, fiscal_month = resolve_checkin(checkin_date)
+    if ZIP_PLUS4_MATCHER.match(zipcode) is not None:
+        zipcode = zipcode.split('-')[0].strip()
+    return state, city, zipcode, fiscal_year, fiscal_month
+
+
+def get_gsa_perdiem(row, rates=None):
+    """GSA perdiem for a non-Utah stay row or None when the stay can't be rated. rates: GsaRateProvider."""
+    try:
+        state, city, zipcode, fiscal_year, fiscal_month = parse_gsa_stay(row)
+    except ValueError:
+        print('BAD CHECKIN', row['ROW_ID'].strip(), row['CHECKIN_DATE'].strip())
+        METRICS.skip('bad checkin')
+        return None
+
+    try:
+        destination = (GSA_RATES if rates is None else rates).get_destination_rate(state, city, zipcode, fiscal_year)
+    except Exception as e:
+        print(e)
+        METRICS.skip('no GSA rate')
+        return None
+    return destination.get_rate(fiscal_month)
+
+
+def collect_rate_requests(data):
+    """Collect the unique GSA requests needed by the non-Utah stays, keyed by get_rate_key."""
+    rate_requests = {}
+    with open(data, 'r') as stays:
+        reader = csv.DictReader(stays)
+        for row in reader:
+            if row['STATE'].strip() == 'UT':
+                continue
+            try:
+                state, city, zipcode, fiscal_year, fiscal_month = parse_gsa_stay(row)
+            except ValueError:
+                continue
+            rate_key = get_rate_key(fiscal_year, zipcode, state)
+            if rate_key not in rate_requests:
+                rate_requests[rate_key] = (state, city, zipcode, fiscal_year)
+
+    return rate_requests
+
+
+def collect_history_requests(fiscal_year, json_paths=(), rate_cache=None):
+    """
+    GSA requests for fiscal_year at every destination in earlier years' rates, keyed by get_rate_key.
+    Destinations come from legacy rates_<FY>.json files and a RateCache.
+    """
+    fiscal_year = str(fiscal_year)
+    rate_requests = {}
+
+    def add(record):
+        rate_key = get_rate_key(fiscal_year, record['zipcode'], record['state'])
+        if rate_key not in rate_requests:
+            rate_requests[rate_key] = (record['state'], record['city'], record['zipcode'], fiscal_year)
+
+    for json_path in json_paths:
+        with open(json_path, 'r') as json_file:
+            for record in json.load(json_file).values():
+                add(record)
+    if rate_cache is not None:
+        for rate_key in rate_cache.keys():
+            add(rate_cache.get(rate_key))
+
+    return rate_requests
+
+
+def warm_rates(rate_requests, rates=None, workers=FETCH_WORKERS):
+    """
+    Fetch the rates a run will need ahead of time so the run itself never waits on the GSA API.
+    Only requests missing from the caches, bulk tables and known missing destinations are fetched.
+    Returns coverage counts: requested, cached, bulk, fetched, no_rates and failed.
+    """
+    rates = GSA_RATES if rates is None else rates
+    coverage = {'requested': len(rate_requests), 'cached': 0, 'bulk': 0, 'fetched': 0, 'no_rates': 0, 'failed': 0}
+    uncached = {}
+    for rate_key, request in rate_requests.items():
+        state, city, zipcode, fiscal_year = request
+        if rates.get_cached_rate(rate_key) is not None:
+            coverage['cached'] += 1
+        elif rates.bulk_rates.get(fiscal_year, zipcode, state):
+            coverage['bulk'] += 1
+        elif rates.is_missing(rate_key):
+            coverage['no_rates'] += 1
+        else:
+            uncached[rate_key] = request
+
+    rates.prefetch(uncached, max(workers, 1))
+    for rate_key in uncached:
+        if rates.get_cached_rate(rate_key) is not None:
+            coverage['fetched'] += 1
+        elif rates.is_missing(rate_key):
+            coverage['no_rates'] += 1
+        else:
+            coverage['failed'] += 1
+    return coverage
+
+
+def print_coverage(coverage):
+    """Report warm_rates coverage. Everything but failed requests is answered without the API."""
+    requested = coverage['requested']
+    for name in ('cached', 'bulk', 'fetched', 'no_rates', 'failed'):
+        print('{:<10}{:>8}  {:.1%}'.format(name, coverage[name], coverage[name] / float(requested or 1)))
+    local = requested - coverage['failed']
+    print('{} of {} GSA rates answered locally ({:.1%}), {} with rates'.format(
+        local, requested, local / float(requested or 1),
+        coverage['cached'] + coverage['bulk'] + coverage['fetched']))
+
+
+def add_perdiem_from_gsa(data, output_csv, fetch_workers=FETCH_WORKERS, rates=None):
+    """Add GSA perdiem to hotel stays for non-Utah data. rates: GsaRateProvider, GSA_RATES by default."""
+    rates = GSA_RATES if rates is None else rates
+    if fetch_workers:
+        with METRICS.timer('prefetch'):
+            rates.prefetch(collect_rate_requests(data), fetch_workers)
+
+    with METRICS.timer('gsa_stays'), open(data, 'r') as stays, open(output_csv, 'w', newline='') as output:
         reader = csv.DictReader(stays)
         writer = csv.writer(output)
         if 'PERDIEM' not in reader.fieldnames:
@@ -292,173 +766,374 @@ def add_perdiem_from_gsa(data, output_csv):
         else:
             writer.writerow(reader.fieldnames)
 
+        write_seconds = 0.0
         for row in reader:
-            id_num, state, city, zipcode, checkin_date = (
-                                                  int(row['ROW_ID'].strip()),
-                                                  row['STATE'].strip(),
-                                                  row['CITY'].strip(),
-                                                  row['ZIP_CODE'].strip(),
-                                                  row['CHECKIN_DATE'].strip())
-            print(id_num)
-            try:
-                if state == 'UT':  # Utah stays are run on separate utah specific rates.
-                    continue
-
-            except KeyError:
-                print('NOT FOUND', id_num, state, zipcode)
-                continue
-
-            try:
-                fiscal_year = get_fiscal_year(checkin_date)
-            except ValueError:
-                print('BAD CHECKIN', id_num, checkin_date)
+            METRICS.row()
+            if row['STATE'].strip() == 'UT':  # Utah stays are run on separate utah specific rates.
                 continue
 
-            if ZIP_PLUS4_MATCHER.match(zipcode) is not None:
-                zipcode = zipcode.split('-')[0].strip()
-            try:
-                destination = get_destination_rate(state, city, zipcode, fiscal_year)
-            except Exception as e:
-                print(e)
+            perdiem = get_gsa_perdiem(row, rates)
+            if perdiem is None:
                 continue
-            rate_date = datetime.strftime(datetime.strptime(checkin_date, date_string), RATE_DATE_FORMAT)
-            row['PERDIEM'] = destination.rates[rate_date]
+            row['PERDIEM'] = perdiem
+            start = time.perf_counter()
             writer.writerow([row[field] for field in reader.fieldnames])  # write result row
+            write_seconds += time.perf_counter() - start
+        METRICS.incr('time.write', write_seconds)
 
 
-def run_table(data, serialized_rates_json, output_csv):
-    """Run the non-Utah stays."""
-    if os.path.exists(rates_json):
-        load_tables(rates_json)
-    try:
-        add_perdiem_from_gsa(data, output_csv)
-    except Exception as e:
-        save_tables(Gsa_Destination_Rate.request_key_rates, rates_json)
-        raise e
+def run_table(data, rates_db, output_csv, fetch_workers=FETCH_WORKERS, add_perdiem=add_perdiem_from_gsa,
+              rates=None):
+    """
+    Run the non-Utah stays. Fetched rates are committed to the rates_db cache as they arrive.
+    - add_perdiem: add_perdiem_from_gsa or an alternate engine with the same signature.
+    - rates: GsaRateProvider to open rates_db on, GSA_RATES by default."""
+    rates = GSA_RATES if rates is None else rates
+    open_rate_cache(rates_db, sorted(glob.glob('gsa_destination_rates/rates_*.json')), rates)
+    add_perdiem(data, output_csv, fetch_workers, rates=rates)
+
+
+# arrayformulas added to the first data row for google sheet, keyed by column offset from the end
+SHEETS_FORMULAS = {
+    -5: '=ARRAYFORMULA(If(ISBLANK($S2:$S),"", $R2:$R-$S2:$S))',
+    -4: '=ARRAYFORMULA(TO_PERCENT(If(ISBLANK($S2:$S),"", $T2:$T/$S2:$S)))',
+    -3: '=ARRAYFORMULA(If(ISBLANK($S2:$S),"", $T2:$T*$Q2:$Q))'
+}
 
-    save_tables(Gsa_Destination_Rate.request_key_rates, rates_json)
 
+class SheetsCsvWriter(object):
+    """Write combined result rows as a csv ready to load as a Google sheet."""
 
-def _combine_result_tables(result_folder, csv_tables, output_csv):
-    fields = None
-    data_rows = 0
-    with open(csv_tables[0], 'r') as result:
-        reader = csv.DictReader(result)
-        fields = reader.fieldnames
-        for row in reader:
-            data_rows += 1
+    def __init__(self, output, fieldnames, append=False):
+        """append: continue an existing results csv without writing the header or formulas again."""
+        self._writer = csv.writer(output, quoting=csv.QUOTE_ALL)
+        if not append:
+            self._writer.writerow(fieldnames)
+        self._needs_formulas = not append
+        self.rows = 0
+
+    @staticmethod
+    def sheets_values(values, first_row=False):
+        """Result values as written for google sheets."""
+        values = [str(v) for v in values]
+        if first_row:
+            for column, formula in SHEETS_FORMULAS.items():
+                values[column] = formula
+        return ['\'' + v if v.startswith('00') else v for v in values]  # keep leading zeros
+
+    def writerow(self, values):
+        self._writer.writerow(self.sheets_values(values, self._needs_formulas))
+        self._needs_formulas = False
+        self.rows += 1
 
-    with open(output_csv, 'w', newline='') as output:
-        writer = csv.writer(output, quoting=csv.QUOTE_ALL)
-        writer.writerow(fields)
-        total_rows = 0
+
+def _combine_result_tables(result_folder, csv_tables, output_csv, result_writers=()):
+    """
+    Stream result tables into one Sheets csv. The header is taken from the first table.
+    result_writers: factories called with the fieldnames for writers that also get every row, see pipeline.run_pipeline.
+    """
+    with METRICS.timer('combine'), ExitStack() as stack:
+        output = stack.enter_context(open(output_csv, 'w', newline=''))
+        writers = []
         for table in csv_tables:
             with open(table, 'r') as t:
                 reader = csv.reader(t)
-                next(reader)
-                # add arrayformulas into first data row for google sheet
-                if total_rows == 0:
-                    first_data_row = next(reader)
-                    first_data_row[-5] = '=ARRAYFORMULA(If(ISBLANK($S2:$S),"", $R2:$R-$S2:$S))'
-                    first_data_row[-4] = '=ARRAYFORMULA(TO_PERCENT(If(ISBLANK($S2:$S),"", $T2:$T/$S2:$S)))'
-                    first_data_row[-3] = '=ARRAYFORMULA(If(ISBLANK($S2:$S),"", $T2:$T*$Q2:$Q))'
-                    writer.writerow(['\'' + v if v.startswith('00') else v for v in first_data_row])
-                    total_rows += 1
-
+                fields = next(reader, None)
+                if not writers and fields is not None:
+                    writers = [SheetsCsvWriter(output, fields)]
+                    writers += [stack.enter_context(open_writer(fields)) for open_writer in result_writers]
                 for row in reader:
-                    total_rows += 1
-                    writer.writerow(['\'' + v if v.startswith('00') else v for v in row])
-        print('Total result rows:', total_rows)
+                    for writer in writers:
+                        writer.writerow(row)
+        print('Total result rows:', writers[0].rows if writers else 0)
+
+
+def format_sample_record(row):
+    """Format a result row for manual verification."""
+    return 'ROW_ID:{}\n{}, {} {}\nYear: {} \nRate: {}'.format(
+        row['ROW_ID'].replace('`', ''),
+        row['CITY'],
+        lookup_state(row['STATE']),
+        row['ZIP_CODE'].replace('`', ''),
+        row['CHECKIN_DATE'].strip(),
+        str(row['PERDIEM']).replace('`', ''))
+
+
+class ReservoirSample(object):
+    """Uniform random sample of n items from a stream of unknown length."""
+
+    def __init__(self, n):
+        self.n = n
+        self.items = []
+        self.seen = 0
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.n:
+            self.items.append(item)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.n:
+                self.items[i] = item
+
+    def merge(self, other):
+        """Combine with a sample of another stream so the result is a uniform sample of both streams."""
+        merged = ReservoirSample(self.n)
+        merged.seen = self.seen + other.seen
+        sources = [[list(self.items), self.seen], [list(other.items), other.seen]]
+        for items, seen in sources:
+            random.shuffle(items)
+        while len(merged.items) < self.n and any(items for items, seen in sources):
+            # draw from each stream in proportion to how many of its items are still unsampled
+            source = sources[0] if random.randrange(sources[0][1] + sources[1][1]) < sources[0][1] else sources[1]
+            if not source[0]:
+                continue
+            merged.items.append(source[0].pop())
+            source[1] -= 1
+        return merged
 
 
 def _get_random_sample(records, n, skip_utah=False):
-    import random
-    record_ids = {}
-    sample = set()
-    sample_num = 1
+    """Formatted records of a uniform random sample of n result rows, read in one pass."""
+    sample = ReservoirSample(n)
     with open(records, 'r') as r:
         reader = csv.DictReader(r)
         for row in reader:
             if skip_utah and row['STATE'] == 'UT':
                 continue
+            sample.add(row)
 
-            record_ids[sample_num] = 'ROW_ID:{}\n{}, {} {}\nYear: {} \nRate: {}'.format(
-                row['ROW_ID'].replace('`', ''),
-                row['CITY'],
-                lookup_state(row['STATE']),
-                row['ZIP_CODE'].replace('`', ''),
-                row['CHECKIN_DATE'].strip(),
-                row['PERDIEM'].replace('`', ''))
-            sample_num += 1
+    return [format_sample_record(row) for row in sample.items]
 
-    while len(sample) <= n:
-        try:
-            id_num = random.randint(1, sample_num)
-            sample.add(record_ids[id_num])
 
-        except KeyError:
-            continue
+MAX_ID_BITMAP_BYTES = 64 * 1024 * 1024  # widest ROW_ID range compared as bitmaps, sparser ids are sorted
+ID_BITMAP_BYTES_PER_ID = 16  # bitmap bytes allowed per id, about the size of the sorted arrays it replaces
+BIT_COUNTS = bytes(bin(byte).count('1') for byte in range(256))
+
 
-    return sample
+def read_row_ids(csv_path):
+    """ROW_IDs of a stays or results csv as an array of 64 bit ints."""
+    row_ids = array('q')
+    with open(csv_path, 'r') as rows:
+        reader = csv.reader(rows)
+        id_column = next(reader).index('ROW_ID')
+        for row in reader:
+            if not row:  # blank lines, which DictReader skipped
+                continue
+            row_ids.append(int(row[id_column].replace('\'', '')))
+    return row_ids
+
+
+def _id_bitmap(row_ids, low, size):
+    bits = bytearray(size)
+    for row_id in row_ids:
+        offset = row_id - low
+        bits[offset >> 3] |= 1 << (offset & 7)
+    return bits
+
+
+def _bitmap_ids(bits, low, other):
+    """Ascending ids set in bits but not in other. Runs of zero bytes are skipped by the regex engine."""
+    for match in re.finditer(b'[^\x00]', bits):
+        byte = match.group()[0] & ~other[match.start()]
+        for bit in range(8):
+            if byte >> bit & 1:
+                yield low + match.start() * 8 + bit
+
+
+def diff_row_ids(stay_ids, result_ids):
+    """
+    Compare stay and result ROW_ID arrays.
+    Returns (missing, extra, stay_count, result_count): ascending stay ids without a result, result ids without a
+    stay and the unique id counts. Ids dense enough that a bitmap is no bigger than the sorted arrays are compared
+    as bitmaps, sparser ids as sorted arrays.
+    """
+    if not stay_ids or not result_ids:
+        stays, results = sorted(set(stay_ids)), sorted(set(result_ids))
+        return stays, results, len(stays), len(results)
+    low = min(min(stay_ids), min(result_ids))
+    size = (max(max(stay_ids), max(result_ids)) - low) // 8 + 1
+    if size <= min(MAX_ID_BITMAP_BYTES, ID_BITMAP_BYTES_PER_ID * (len(stay_ids) + len(result_ids))):
+        stay_bits, result_bits = _id_bitmap(stay_ids, low, size), _id_bitmap(result_ids, low, size)
+        return (list(_bitmap_ids(stay_bits, low, result_bits)), list(_bitmap_ids(result_bits, low, stay_bits)),
+                sum(stay_bits.translate(BIT_COUNTS)), sum(result_bits.translate(BIT_COUNTS)))
+
+    stays, results = array('q', sorted(set(stay_ids))), array('q', sorted(set(result_ids)))
+    missing, extra = [], []
+    i = j = 0
+    while i < len(stays) and j < len(results):
+        if stays[i] == results[j]:
+            i += 1
+            j += 1
+        elif stays[i] < results[j]:
+            missing.append(stays[i])
+            i += 1
+        else:
+            extra.append(results[j])
+            j += 1
+    missing.extend(stays[i:])
+    extra.extend(results[j:])
+    return missing, extra, len(stays), len(results)
 
 
 def find_missing_records(stays, results):
-    result_ids = set()
-    stay_ids = set()
-    with open(results, 'r') as r:
-        results_reader = csv.DictReader(r)
-        for row in results_reader:
-            result_ids.add(int(row['ROW_ID'].replace('\'', '')))
-    with open(stays, 'r') as s:
-        reader = csv.DictReader(s)
-        for row in reader:
-            stay_ids.add(int(row['ROW_ID'].replace('\'', '')))
-    for stay_id in stay_ids:
-        if stay_id not in result_ids:
-            print('missing stay', stay_id)
-    for result_id in result_ids:
-        if result_id not in stay_ids:
-            print('result', result_id)
-    print
-    print('total results', len(result_ids))
-    print('total stays', len(stay_ids))
+    """Print stays without a result row and result rows without a stay."""
+    missing, extra, stay_count, result_count = diff_row_ids(read_row_ids(stays), read_row_ids(results))
+    for stay_id in missing:
+        print('missing stay', stay_id)
+    for result_id in extra:
+        print('result', result_id)
+    print()
+    print('total results', result_count)
+    print('total stays', stay_count)
 
 
-if __name__ == '__main__':
-    """Currently uses web-scraping3 python virtual env"""
-    data = 'stays/All_Stays_2020Q3.csv'
+def main():
+    """Command line entry point. Currently uses web-scraping3 python virtual env"""
+    parser = argparse.ArgumentParser(description='Add federal and Utah hotel per diems to hotel stay data.')
+    parser.add_argument('--stays', default='stays/All_Stays_2020Q3.csv', help='stay csv from State Travel')
     # Year and quarter for output file naming
-    utah_fiscal_year = '2020'
-    quarter = 'q3'
-
-    output_suffix = utah_fiscal_year + '_' + quarter
-    non_utah_output = 'results/non_utah_{}.csv'.format(output_suffix)
-    print('\n!!!!!US stays!!!!!!!')
-    rates_json = 'gsa_destination_rates/rates_{}.json'.format(utah_fiscal_year)
-    run_table(data, rates_json, non_utah_output)
+    parser.add_argument('--fiscal-year', default='2020', help='Utah fiscal year for output file naming')
+    parser.add_argument('--quarter', default='q3', help='quarter for output file naming')
+    parser.add_argument('--staged', action='store_true',
+                        help='write separate non-Utah and Utah results and combine them afterwards '
+                             'instead of the single pass pipeline')
+    parser.add_argument('--region-files', action='store_true',
+                        help='also write the non-Utah and Utah result files from the single pass pipeline')
+    parser.add_argument('--manifest', help='SQLite run manifest. Reruns only enrich new or changed stays, '
+                                           'appending or patching the combined results')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes for the single pass pipeline. Uncached GSA rates are fetched first '
+                             'and the stays are split into chunks rated in parallel')
+    parser.add_argument('--fetch-workers', type=int, default=FETCH_WORKERS,
+                        help='concurrent GSA requests while prefetching rates, 0 disables the prefetch')
+    parser.add_argument('--requests-per-second', type=positive_float, default=REQUESTS_PER_SECOND,
+                        help='sustained GSA request rate shared by all fetch workers')
+    parser.add_argument('--timeout', type=float, default=30, help='GSA read timeout in seconds')
+    parser.add_argument('--rates-db', default=RATE_CACHE_DB, help='SQLite cache of GSA destination rates')
+    parser.add_argument('--memory-rates', type=int, default=None,
+                        help='most GSA destination rates held in memory, least recently used are reloaded from '
+                             '--rates-db. Unlimited by default')
+    parser.add_argument('--bulk', nargs=3, action='append', default=[],
+                        metavar=('FISCAL_YEAR', 'ZIP_FILE', 'RATES_FILE'),
+                        help='GSA bulk ZIP->destination and destination->rates tables (csv, json or xlsx). '
+                             'The API is only called for zips missing from the bulk tables. Can be repeated.')
+    parser.add_argument('--fallback', choices=FALLBACK_POLICIES, default=None,
+                        help='rates for zips GSA has no rates for: the standard GSA rate or the most common cached '
+                             'rate in the state. Those stays are skipped by default')
+    parser.add_argument('--missing-ttl', type=float, default=MISSING_RATE_TTL / 86400.0,
+                        help='days before a zip GSA had no rates for is requested again')
+    parser.add_argument('--engine', choices=['csv', 'pandas', 'async'], default='csv',
+                        help='pandas reads the stays once and enriches whole columns at a time. async reads the '
+                             'non-Utah stays while their GSA requests are in flight. Both imply --staged')
+    parser.add_argument('--dataset', help='also write typed results to this folder, partitioned by '
+                                          '--fiscal-year and --quarter. Requires pyarrow')
+    parser.add_argument('--dataset-format', choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument('--metrics', help='write a json run report of counters, timings and GSA latencies')
+    parser.add_argument('--progress', action='store_true', help='print a progress line to stderr every few seconds')
+    parser.add_argument('--profile', help='run under cProfile and save the stats to this path')
+    args = parser.parse_args()
+    if args.manifest:
+        if args.staged or args.engine != 'csv':
+            parser.error('--manifest is only supported by the single pass csv pipeline, not --staged or --engine '
+                         'pandas/async')
+        if args.workers > 1:
+            parser.error('--manifest is not supported with --workers')
+        if args.region_files or args.dataset:
+            parser.error('--manifest is not supported with --region-files or --dataset')
+    if args.progress:
+        METRICS.progress_stream = sys.stderr
+    GSA_RATE_LIMITER.set_rate(args.requests_per_second)
+    configure_gsa_session(pool_size=max(args.fetch_workers, 1), timeout=(5, args.timeout))
+    gsa_rates = GsaRateProvider(memory_size=args.memory_rates, session=GSA_SESSION, limiter=GSA_RATE_LIMITER,
+                                fallback=args.fallback, missing_ttl=args.missing_ttl * 86400)
+    for bulk_fiscal_year, bulk_zips, bulk_rates in args.bulk:
+        load_bulk_rates(bulk_fiscal_year, bulk_zips, bulk_rates, gsa_rates)
 
-    # Run utah_perdiems.py
     from utah_perdiem import create_rate_areas
     from utah_perdiem import get_rate_for_stays
-    utah_perdiems_csv = r'utah_rates.csv'
+    data = args.stays
+    output_suffix = args.fiscal_year + '_' + args.quarter
+    non_utah_output = 'results/non_utah_{}.csv'.format(output_suffix)
     utah_output = 'results/utah_{}.csv'.format(output_suffix)
-    print('\n!!!!!Utah Stays!!!!!!!')
-    city_areas = create_rate_areas(utah_perdiems_csv)
-    get_rate_for_stays(city_areas, data, utah_output)
-
-    # Combine non_utah and utah results
-    print('\n!!!!!Combine!!!!!!!')
-    result_folder = 'results'
-    csv_tables = [non_utah_output, utah_output]
     combined_output = 'results/results_{}.csv'.format(output_suffix)
-    _combine_result_tables(result_folder, csv_tables, combined_output)
-    print('Results at {}'.format(combined_output))
-    find_missing_records(data, combined_output)
+    utah_perdiems_csv = r'utah_rates.csv'
+    result_writers = []
+    if args.dataset:
+        from result_writers import dataset_writer_factory
+        result_writers.append(dataset_writer_factory(args.dataset, args.fiscal_year, args.quarter,
+                                                     args.dataset_format))
+
+    with profiled(args.profile):
+        if not args.staged and args.engine == 'csv':
+            import pipeline
+            open_rate_cache(args.rates_db, sorted(glob.glob('gsa_destination_rates/rates_*.json')), gsa_rates)
+            if args.workers > 1:
+                summary = pipeline.run_sharded_pipeline(data, utah_perdiems_csv, args.rates_db, combined_output,
+                                                        args.workers,
+                                                        non_utah_output if args.region_files else None,
+                                                        utah_output if args.region_files else None,
+                                                        fetch_workers=args.fetch_workers,
+                                                        bulk_tables=args.bulk,
+                                                        gsa_rates=gsa_rates,
+                                                        result_writers=result_writers)
+            else:
+                run_manifest = None
+                if args.manifest:
+                    from manifest import RunManifest
+                    run_manifest = RunManifest(args.manifest, combined_output)
+                city_areas = create_rate_areas(utah_perdiems_csv)
+                summary = pipeline.run_pipeline(data, city_areas, combined_output,
+                                                non_utah_output if args.region_files else None,
+                                                utah_output if args.region_files else None,
+                                                fetch_workers=args.fetch_workers,
+                                                manifest=run_manifest,
+                                                gsa_rates=gsa_rates,
+                                                result_writers=result_writers)
+            print('Results at {}'.format(combined_output))
+            summary.report()
+        else:
+            add_perdiem = add_perdiem_from_gsa
+            if args.engine == 'pandas':
+                import vectorized_perdiem
+                stays = vectorized_perdiem.read_stays(data)
+                add_perdiem = functools.partial(vectorized_perdiem.add_perdiem_from_gsa, stays=stays)
+                get_rate_for_stays = functools.partial(vectorized_perdiem.get_rate_for_stays, stays=stays)
+            elif args.engine == 'async':
+                import async_gsa
+                add_perdiem = async_gsa.add_perdiem_from_gsa
+
+            print('\n!!!!!US stays!!!!!!!')
+            run_table(data, args.rates_db, non_utah_output, args.fetch_workers, add_perdiem, gsa_rates)
+
+            # Run utah_perdiems.py
+            print('\n!!!!!Utah Stays!!!!!!!')
+            city_areas = create_rate_areas(utah_perdiems_csv)
+            get_rate_for_stays(city_areas, data, utah_output)
+
+            # Combine non_utah and utah results
+            print('\n!!!!!Combine!!!!!!!')
+            result_folder = 'results'
+            csv_tables = [non_utah_output, utah_output]
+            _combine_result_tables(result_folder, csv_tables, combined_output, result_writers)
+            print('Results at {}'.format(combined_output))
+            find_missing_records(data, combined_output)
+
+            # Get a random sample of record for verification.
+            print()
+            print('----Verification random sample----')
+            sample = _get_random_sample(combined_output, 10, skip_utah=False)
+            for rate in sample:
+                print(rate)
+                print()
+
+    if args.metrics:
+        METRICS.write_report(args.metrics)
+        print('Run report at {}'.format(args.metrics))
 
-    # Get a random sample of record for verification.
-    print()
-    print('----Verification random sample----')
-    sample = _get_random_sample(combined_output, 10, skip_utah=False)
-    for rate in sample:
-        print(rate)
-        print()
\ No newline at end of file
+
+if __name__ == '__main__':
+    # Run through the imported module so the providers, exceptions and session are the ones pipeline, async_gsa and
+    # vectorized_perdiem see, not copies defined in __main__.
+    import perdiem
+    perdiem.main()
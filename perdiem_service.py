@@ -0,0 +1,207 @@
+"""
+Local HTTP/JSON per diem lookup service.
+Keeps the GSA rate provider and the Utah rate areas warm so other tools can look up single stays.
+
+    GET  /perdiem?state=CO&city=Denver&zip=80202&checkin=3/14/2020
+    POST /perdiem/batch    [{"state": "UT", "city": "Moab", "checkin": "7/4/2020"}, ...]
+    GET  /stats
+"""
+import argparse
+import glob
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import perdiem
+import utah_perdiem
+from run_metrics import METRICS
+
+MAX_BATCH = 10000  # most lookups in one batch request
+
+
+class PerdiemLookupError(ValueError):
+    """A lookup that can't be answered. The message is returned to the client."""
+
+
+class PerdiemService(object):
+    """
+    Per diem lookups for single stays.
+    - gsa_rates: perdiem.GsaRateProvider answering non-Utah stays.
+    - city_areas: {city: RateArea} from utah_perdiem.create_rate_areas.
+    - offline: only answer from cached and bulk GSA rates, never call the API.
+    """
+
+    def __init__(self, gsa_rates, city_areas, offline=False):
+        self.gsa_rates = gsa_rates
+        self.city_areas = city_areas
+        self.offline = offline
+
+    def lookup(self, params):
+        """
+        Per diem for a {state, city, zip, checkin} lookup. zip is not needed for Utah stays.
+        Raises PerdiemLookupError when the stay can't be rated.
+        """
+        start = time.perf_counter()
+        METRICS.incr('service.lookups')
+        try:
+            row = {'STATE': str(params.get('state', '')),
+                   'CITY': str(params.get('city', '')),
+                   'ZIP_CODE': str(params.get('zip', '')),
+                   'CHECKIN_DATE': str(params.get('checkin', ''))}
+            if not row['STATE'].strip() or not row['CHECKIN_DATE'].strip():
+                raise PerdiemLookupError('state and checkin are required')
+            if row['STATE'].strip().upper() == 'UT':
+                return self._utah_lookup(row)
+            return self._gsa_lookup(row)
+        except PerdiemLookupError:
+            METRICS.incr('service.lookup_errors')
+            raise
+        finally:
+            METRICS.observe('service.lookup_seconds', time.perf_counter() - start)
+
+    def _utah_lookup(self, row):
+        try:
+            rate, city, not_found_msg = utah_perdiem.get_stay_rate(self.city_areas, row)
+        except ValueError:
+            raise PerdiemLookupError('Bad check-in date: {}'.format(row['CHECKIN_DATE']))
+        return {'perdiem': rate, 'source': 'utah', 'city': city, 'default_rate': not_found_msg is not None}
+
+    def _gsa_lookup(self, row):
+        try:
+            state, city, zipcode, fiscal_year, fiscal_month = perdiem.parse_gsa_stay(row)
+        except ValueError as e:
+            raise PerdiemLookupError(str(e))
+        if not zipcode:
+            raise PerdiemLookupError('zip is required outside Utah')
+        if self.offline:
+            destination = self.gsa_rates.get_local_rate(state, city, zipcode, fiscal_year)
+            if destination is None:
+                raise PerdiemLookupError('No cached GSA rate for {} {}'.format(zipcode, fiscal_year))
+        else:
+            try:
+                destination = self.gsa_rates.get_destination_rate(state, city, zipcode, fiscal_year)
+            except Exception as e:
+                raise PerdiemLookupError(str(e))
+        return {'perdiem': destination.get_rate(fiscal_month), 'source': 'gsa', 'city': destination.city,
+                'fiscal_year': fiscal_year, 'request_key': destination.request_key}
+
+    def lookup_batch(self, lookups):
+        """Results in lookup order. Lookups that fail get an error instead of a perdiem."""
+        results = []
+        for params in lookups:
+            try:
+                results.append(self.lookup(params))
+            except PerdiemLookupError as e:
+                results.append({'error': str(e)})
+        return results
+
+    def stats(self):
+        rate_cache = self.gsa_rates.rate_cache
+        return {'memory_rates': len(self.gsa_rates.memory),
+                'memory_size': self.gsa_rates.memory.maxsize,
+                'cached_rates': None if rate_cache is None else len(rate_cache),
+                'utah_cities': len(self.city_areas),
+                'offline': self.offline,
+                'metrics': METRICS.report()}
+
+
+def preload_rates(gsa_rates):
+    """Load the most recent fiscal years of the provider's rate cache into its memory tier. Returns the count."""
+    if gsa_rates.rate_cache is None:
+        return 0
+    rate_keys = sorted(gsa_rates.rate_cache.keys(), reverse=True)
+    if gsa_rates.memory.maxsize is not None:
+        rate_keys = rate_keys[:gsa_rates.memory.maxsize]
+    for rate_key in reversed(rate_keys):
+        gsa_rates.get_cached_rate(rate_key)
+    return len(rate_keys)
+
+
+def make_server(service, host='127.0.0.1', port=8765):
+    """ThreadingHTTPServer answering lookups with service."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/perdiem':
+                try:
+                    self._send(200, service.lookup(dict(parse_qsl(url.query))))
+                except PerdiemLookupError as e:
+                    self._send(400, {'error': str(e)})
+            elif url.path == '/stats':
+                self._send(200, service.stats())
+            elif url.path == '/health':
+                self._send(200, {'status': 'ok'})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if urlsplit(self.path).path != '/perdiem/batch':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                lookups = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                self._send(400, {'error': 'body must be a json list of lookups'})
+                return
+            if not isinstance(lookups, list) or not all(isinstance(params, dict) for params in lookups):
+                self._send(400, {'error': 'body must be a json list of lookups'})
+            elif len(lookups) > MAX_BATCH:
+                self._send(400, {'error': 'at most {} lookups per batch'.format(MAX_BATCH)})
+            else:
+                self._send(200, service.lookup_batch(lookups))
+
+        def _send(self, status, body):
+            content = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve per diem lookups over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rates-db', default=perdiem.RATE_CACHE_DB, help='SQLite cache of GSA destination rates')
+    parser.add_argument('--utah-rates', default='utah_rates.csv')
+    parser.add_argument('--memory-rates', type=int, default=None, help='most GSA rates held in memory')
+    parser.add_argument('--bulk', nargs=3, action='append', default=[],
+                        metavar=('FISCAL_YEAR', 'ZIP_FILE', 'RATES_FILE'),
+                        help='GSA bulk rate tables. Can be repeated.')
+    parser.add_argument('--requests-per-second', type=perdiem.positive_float, default=perdiem.REQUESTS_PER_SECOND,
+                        help='sustained GSA request rate for rates missing from the caches')
+    parser.add_argument('--fallback', choices=perdiem.FALLBACK_POLICIES, default=None,
+                        help='rates for zips GSA has no rates for, lookups of those zips fail by default')
+    parser.add_argument('--missing-ttl', type=float, default=perdiem.MISSING_RATE_TTL / 86400.0,
+                        help='days before a zip GSA had no rates for is requested again')
+    parser.add_argument('--offline', action='store_true', help='never call the GSA API')
+    args = parser.parse_args()
+
+    perdiem.GSA_RATE_LIMITER.set_rate(args.requests_per_second)
+    gsa_rates = perdiem.GsaRateProvider(memory_size=args.memory_rates, fallback=args.fallback,
+                                        missing_ttl=args.missing_ttl * 86400)
+    perdiem.open_rate_cache(args.rates_db, sorted(glob.glob('gsa_destination_rates/rates_*.json')), gsa_rates)
+    for bulk_fiscal_year, bulk_zips, bulk_rates in args.bulk:
+        perdiem.load_bulk_rates(bulk_fiscal_year, bulk_zips, bulk_rates, gsa_rates)
+    city_areas = utah_perdiem.create_rate_areas(args.utah_rates)
+    print('Loaded {} cached GSA rates into memory'.format(preload_rates(gsa_rates)))
+
+    server = make_server(PerdiemService(gsa_rates, city_areas, args.offline), args.host, args.port)
+    print('Per diem lookups at http://{}:{}'.format(args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,419 @@
+"""
+Single pass pipeline for hotel stays.
+Reads the stays csv once, rates each row with Utah or GSA per diems and writes the combined Google Sheets csv.
+"""
+import csv
+import io
+import locale
+import os
+import queue
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import Pool
+
+import perdiem
+import utah_perdiem
+from rate_cache import RateCache
+from run_metrics import METRICS
+
+
+class PipelineSummary(object):
+    """Counts, missing stays and a verification sample collected while the stays are processed."""
+
+    def __init__(self, sample_size):
+        self.rows_read = 0
+        self.rows_written = 0
+        self.rows_unchanged = 0  # already in the results from an earlier run
+        self.missing = {}  # ROW_ID -> reason the stay has no result row
+        self.utah_not_found = {}  # city -> message, these stays got the Utah default rate
+        self.sample = perdiem.ReservoirSample(sample_size)
+
+    def merge(self, other):
+        self.rows_read += other.rows_read
+        self.rows_written += other.rows_written
+        self.rows_unchanged += other.rows_unchanged
+        self.missing.update(other.missing)
+        self.utah_not_found.update(other.utah_not_found)
+        self.sample = self.sample.merge(other.sample)
+
+    def report(self):
+        for not_found_city, msg in self.utah_not_found.items():
+            print('{} {}'.format(not_found_city, msg))
+        for stay_id, reason in self.missing.items():
+            print('missing stay', stay_id, reason)
+        if self.rows_unchanged:
+            print('unchanged stays from earlier runs', self.rows_unchanged)
+        print('total results', self.rows_written)
+        print('total stays', self.rows_read)
+        print()
+        print('----Verification random sample----')
+        for row in self.sample.items:
+            print(perdiem.format_sample_record(row))
+            print()
+
+
+def _write_patched_results(combined_csv, patch_csv, patched):
+    """Copy a results csv to patch_csv replacing rows by ROW_ID. A None value drops the row."""
+    with open(combined_csv, 'r', newline='') as results, open(patch_csv, 'w', newline='') as output:
+        reader = csv.reader(results)
+        writer = csv.writer(output, quoting=csv.QUOTE_ALL)
+        fieldnames = next(reader)
+        writer.writerow(fieldnames)
+        id_column = fieldnames.index('ROW_ID')
+        first_row = True
+        for row in reader:
+            row_id = row[id_column].replace('\'', '').strip()
+            if row_id not in patched:
+                if first_row:  # the formula row was dropped so the next row carries the formulas
+                    for column, formula in perdiem.SHEETS_FORMULAS.items():
+                        row[column] = formula
+                writer.writerow(row)
+                first_row = False
+            elif patched[row_id] is not None:
+                writer.writerow(perdiem.SheetsCsvWriter.sheets_values(patched[row_id][0], first_row))
+                first_row = False
+
+
+def run_pipeline(data, city_areas, combined_csv, non_utah_csv=None, utah_csv=None,
+                 fetch_workers=perdiem.FETCH_WORKERS, sample_size=10, manifest=None, checkpoint_rows=1000,
+                 gsa_rates=None, result_writers=()):
+    """
+    Add per diems to every stay in one pass and write the combined results.
+    - gsa_rates: perdiem.GsaRateProvider, perdiem.GSA_RATES by default.
+    - non_utah_csv, utah_csv: optional per region result files in the add_perdiem_from_gsa format.
+    - fetch_workers: GSA cache misses are fetched on this many threads while reading continues.
+      Stays waiting on a fetch are written when it completes, so those rows are not in input order.
+    - manifest: RunManifest for combined_csv. Stays already enriched with the same input values are skipped,
+      new stays are appended, changed stays are patched in place and stays no longer in data are removed.
+      Checkpoints every checkpoint_rows rows.
+    - result_writers: factories called with the result fieldnames, e.g. result_writers.dataset_writer_factory.
+      Each writer gets every result row and is closed after the pass.
+    """
+    gsa_rates = perdiem.GSA_RATES if gsa_rates is None else gsa_rates
+    summary = PipelineSummary(sample_size)
+    executor = ThreadPoolExecutor(fetch_workers) if fetch_workers else None
+    pending = {}  # rate_key -> (future, [(row, fiscal_month), ...])
+    fetched = queue.SimpleQueue()  # rate keys whose fetch finished
+    digests = {}  # ROW_ID -> input digest of stays already in combined_csv
+    patched = {}  # ROW_ID -> new result values for changed stays, None when a changed stay has no result
+    removed = set()  # ROW_IDs in combined_csv not seen in data yet, removed after the pass
+    append = False
+    if manifest is not None:
+        if non_utah_csv or utah_csv or result_writers:
+            raise ValueError('Region files and result writers are not supported with a run manifest')
+        digests = manifest.load_digests()
+        committed_size = manifest.committed_size()
+        patch_csv = combined_csv + '.patch'
+        if os.path.exists(patch_csv):  # finish a patch whose checkpoint was committed, otherwise discard it
+            if os.path.getsize(patch_csv) == committed_size:
+                os.replace(patch_csv, combined_csv)
+            else:
+                os.remove(patch_csv)
+        append = bool(digests) and committed_size is not None and os.path.exists(combined_csv)
+        if append:
+            with open(combined_csv, 'r+b') as results:  # drop rows written after the last checkpoint
+                results.truncate(committed_size)
+        else:
+            manifest.reset()
+            digests = {}
+        removed = set(digests)
+
+    with ExitStack() as stack:
+        reader = csv.DictReader(stack.enter_context(open(data, 'r')))
+        stay_fields = list(reader.fieldnames)
+        fieldnames = stay_fields if 'PERDIEM' in stay_fields else stay_fields + ['PERDIEM']
+        combined_file = stack.enter_context(open(combined_csv, 'a' if append else 'w', newline=''))
+        combined = perdiem.SheetsCsvWriter(combined_file, fieldnames, append)
+        region_writers = {}
+        for region, region_csv in (('gsa', non_utah_csv), ('utah', utah_csv)):
+            if region_csv:
+                region_writers[region] = csv.writer(stack.enter_context(open(region_csv, 'w', newline='')))
+                region_writers[region].writerow(fieldnames)
+        output_writers = [stack.enter_context(open_writer(fieldnames)) for open_writer in result_writers]
+
+        write_seconds = 0.0
+
+        def checkpoint():
+            combined_file.flush()
+            manifest.checkpoint(combined_file.tell())
+
+        def write(row, region):
+            nonlocal write_seconds
+            start = time.perf_counter()
+            values = [row[field] for field in fieldnames]
+            summary.rows_written += 1
+            summary.sample.add(row)
+            if manifest is not None:
+                row_id = row['ROW_ID'].replace('\'', '').strip()
+                if row_id in digests:  # changed stays are patched in after the pass
+                    patched[row_id] = (values, row['_digest'])
+                    return
+                manifest.record(row_id, row['_digest'])
+            combined.writerow(values)
+            if region in region_writers:
+                region_writers[region].writerow(values)
+            for output_writer in output_writers:
+                output_writer.writerow(values)
+            if manifest is not None and combined.rows % checkpoint_rows == 0:
+                checkpoint()
+            write_seconds += time.perf_counter() - start
+
+        def skip(row, reason, detail=''):
+            row_id = row['ROW_ID'].replace('\'', '').strip()
+            summary.missing[row_id] = (reason + ' ' + detail).strip()
+            METRICS.skip(reason)
+            if row_id in digests:
+                patched[row_id] = None
+
+        def flush(rate_key):
+            future, rows = pending.pop(rate_key)
+            try:
+                destination = future.result()
+            except Exception as e:
+                print(e)
+                for row, fiscal_month in rows:
+                    skip(row, 'no GSA rate')
+                return
+            for row, fiscal_month in rows:
+                row['PERDIEM'] = destination.get_rate(fiscal_month)
+                write(row, 'gsa')
+
+        for row in reader:
+            summary.rows_read += 1
+            METRICS.row()
+            while not fetched.empty():
+                flush(fetched.get())
+
+            if manifest is not None:
+                row['_digest'] = manifest.row_digest([row[field] for field in stay_fields])
+                row_id = row['ROW_ID'].replace('\'', '').strip()
+                removed.discard(row_id)
+                if digests.get(row_id) == row['_digest']:
+                    summary.rows_unchanged += 1
+                    METRICS.incr('rows.unchanged')
+                    continue
+
+            if row['STATE'].strip().upper() == 'UT':  # Utah stays are run on Utah specific rates.
+                try:
+                    row['PERDIEM'], city, not_found_msg = utah_perdiem.get_stay_rate(city_areas, row)
+                except ValueError:
+                    skip(row, 'bad checkin', row['CHECKIN_DATE'].strip())
+                    continue
+                if not_found_msg is not None:
+                    summary.utah_not_found[city] = not_found_msg
+                    METRICS.incr('utah.default_rates')
+                write(row, 'utah')
+                continue
+
+            try:
+                state, city, zipcode, fiscal_year, fiscal_month = perdiem.parse_gsa_stay(row)
+            except ValueError:
+                skip(row, 'bad checkin', row['CHECKIN_DATE'].strip())
+                continue
+
+            rate_key = perdiem.get_rate_key(fiscal_year, zipcode, state)
+            if rate_key in pending:
+                METRICS.incr('cache.inflight_hits')
+                pending[rate_key][1].append((row, fiscal_month))
+                continue
+
+            destination = gsa_rates.get_local_rate(state, city, zipcode, fiscal_year)
+            if destination is None and gsa_rates.is_missing(rate_key):
+                skip(row, 'no GSA rate')
+                continue
+            if destination is None and executor is not None:
+                future = executor.submit(gsa_rates.get_destination_rate, state, city, zipcode, fiscal_year)
+                pending[rate_key] = (future, [(row, fiscal_month)])
+                future.add_done_callback(lambda f, key=rate_key: fetched.put(key))
+                continue
+            if destination is None:
+                try:
+                    destination = gsa_rates.get_destination_rate(state, city, zipcode, fiscal_year)
+                except Exception as e:
+                    print(e)
+                    skip(row, 'no GSA rate')
+                    continue
+            row['PERDIEM'] = destination.get_rate(fiscal_month)
+            write(row, 'gsa')
+
+        for rate_key in list(pending):
+            flush(rate_key)
+        if executor is not None:
+            executor.shutdown()
+        METRICS.incr('time.write', write_seconds)
+
+    if manifest is not None:
+        manifest.checkpoint(os.path.getsize(combined_csv))
+        for row_id in removed:
+            patched[row_id] = None
+        if patched:
+            _write_patched_results(combined_csv, patch_csv, patched)
+            for row_id, patch in patched.items():
+                if patch is None:
+                    manifest.remove(row_id)
+                else:
+                    manifest.record(row_id, patch[1])
+            manifest.checkpoint(os.path.getsize(patch_csv))
+            os.replace(patch_csv, combined_csv)
+            print('Patched {} changed stays, {} removed from the stays csv'.format(len(patched) - len(removed),
+                                                                                 len(removed)))
+
+    return summary
+
+
+def split_byte_ranges(data, chunks):
+    """
+    Split a csv into (start, end) byte ranges of whole records after the header.
+    Records are found by quote parity so quoted values may contain line breaks. A file whose quotes don't balance
+    is returned as one range.
+    """
+    size = os.path.getsize(data)
+    with open(data, 'rb') as stays:
+        bounds = [None]
+        quotes = 0  # quote characters in the record read so far, an odd count means a line break is inside a value
+        targets = iter(size * i // chunks for i in range(1, chunks))
+        target = next(targets, size)
+        for line in iter(stays.readline, b''):
+            quotes += line.count(b'"')
+            if quotes % 2:
+                continue
+            quotes = 0
+            position = stays.tell()
+            if bounds[0] is None:  # end of the header record
+                bounds[0] = position
+                continue
+            if target <= position < size:
+                bounds.append(position)
+                while target <= position:
+                    target = next(targets, size)
+    if bounds[0] is None:
+        return []
+    if quotes % 2:
+        return [(bounds[0], size)]
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+_worker_city_areas = None
+_worker_gsa_rates = None
+
+
+def _init_worker(rates_db, utah_rates_csv, bulk_tables, memory_size, fallback, missing_ttl):
+    """Load read only rate indexes once per worker process."""
+    global _worker_city_areas, _worker_gsa_rates
+    _worker_gsa_rates = perdiem.GsaRateProvider(RateCache(rates_db), memory_size=memory_size, fallback=fallback,
+                                                missing_ttl=missing_ttl)
+    for fiscal_year, zip_path, destination_path in bulk_tables:
+        _worker_gsa_rates.bulk_rates.ingest(fiscal_year, zip_path, destination_path)
+    _worker_city_areas = utah_perdiem.create_rate_areas(utah_rates_csv)
+
+
+def _enrich_chunk(task):
+    """
+    Rate one byte range of the stays into a chunk file of (region, values...) rows. Never calls the GSA API.
+    Returns the chunk's PipelineSummary and RunMetrics."""
+    data, stay_fields, fieldnames, start, end, chunk_csv, sample_size = task
+    summary = PipelineSummary(sample_size)
+    METRICS.reset()
+    with open(data, 'rb') as stays:
+        stays.seek(start)
+        text = stays.read(end - start).decode(locale.getpreferredencoding(False))
+
+    with open(chunk_csv, 'w', newline='') as chunk:
+        writer = csv.writer(chunk)
+        for row in csv.DictReader(io.StringIO(text, newline=''), fieldnames=stay_fields):
+            summary.rows_read += 1
+            METRICS.row()
+            row_id = row['ROW_ID'].replace('\'', '').strip()
+            try:
+                if row['STATE'].strip().upper() == 'UT':
+                    row['PERDIEM'], city, not_found_msg = utah_perdiem.get_stay_rate(_worker_city_areas, row)
+                else:
+                    state, city, zipcode, fiscal_year, fiscal_month = perdiem.parse_gsa_stay(row)
+            except ValueError:
+                summary.missing[row_id] = 'bad checkin {}'.format(row['CHECKIN_DATE'].strip())
+                METRICS.skip('bad checkin')
+                continue
+
+            if row['STATE'].strip().upper() == 'UT':
+                if not_found_msg is not None:
+                    summary.utah_not_found[city] = not_found_msg
+                    METRICS.incr('utah.default_rates')
+                region = 'utah'
+            else:
+                destination = _worker_gsa_rates.get_local_rate(state, city, zipcode, fiscal_year)
+                if destination is None:
+                    summary.missing[row_id] = 'no GSA rate'
+                    METRICS.skip('no GSA rate')
+                    continue
+                row['PERDIEM'] = destination.get_rate(fiscal_month)
+                region = 'gsa'
+            writer.writerow([region] + [row[field] for field in fieldnames])
+            summary.rows_written += 1
+            summary.sample.add(row)
+
+    return summary, METRICS
+
+
+def run_sharded_pipeline(data, utah_rates_csv, rates_db, combined_csv, workers, non_utah_csv=None, utah_csv=None,
+                         fetch_workers=perdiem.FETCH_WORKERS, bulk_tables=(), sample_size=10, gsa_rates=None,
+                         result_writers=()):
+    """
+    Add per diems with a pool of worker processes.
+    Uncached GSA rates are fetched into rates_db first so workers only read local rates.
+    The stays are split into byte ranges and the chunk results are merged in file order.
+    - bulk_tables: (fiscal_year, zip_path, destination_path) tables each worker ingests.
+    - gsa_rates: perdiem.GsaRateProvider for the prefetch. rates_db is opened as its rate_cache when it has none.
+      Workers get their own providers with the same memory size and fallback policy.
+    - result_writers: factories called with the result fieldnames, see run_pipeline.
+    """
+    gsa_rates = perdiem.GSA_RATES if gsa_rates is None else gsa_rates
+    if gsa_rates.rate_cache is None:
+        perdiem.open_rate_cache(rates_db, rates=gsa_rates)
+    with METRICS.timer('prefetch'):
+        gsa_rates.prefetch(perdiem.collect_rate_requests(data), max(fetch_workers, 1))
+    with open(data, 'r') as stays:
+        stay_fields = next(csv.reader(stays))
+    fieldnames = stay_fields if 'PERDIEM' in stay_fields else stay_fields + ['PERDIEM']
+    try:  # workers map one compiled Utah rate table instead of each parsing the csv
+        utah_perdiem.compile_rate_areas(utah_rates_csv)
+    except OSError as e:
+        print('Could not compile {}: {}'.format(utah_rates_csv, e))
+
+    chunk_folder = tempfile.mkdtemp(prefix='perdiem_chunks_')
+    tasks = [(data, stay_fields, fieldnames, start, end, os.path.join(chunk_folder, '{:06d}.csv'.format(i)),
+              sample_size)
+             for i, (start, end) in enumerate(split_byte_ranges(data, workers * 4))]
+    summary = PipelineSummary(sample_size)
+    try:
+        with ExitStack() as stack:
+            combined = perdiem.SheetsCsvWriter(stack.enter_context(open(combined_csv, 'w', newline='')), fieldnames)
+            region_writers = {}
+            for region, region_csv in (('gsa', non_utah_csv), ('utah', utah_csv)):
+                if region_csv:
+                    region_writers[region] = csv.writer(stack.enter_context(open(region_csv, 'w', newline='')))
+                    region_writers[region].writerow(fieldnames)
+            output_writers = [stack.enter_context(open_writer(fieldnames)) for open_writer in result_writers]
+
+            pool = stack.enter_context(Pool(workers, _init_worker,
+                                            (rates_db, utah_rates_csv, list(bulk_tables), gsa_rates.memory.maxsize,
+                                             gsa_rates.fallback, gsa_rates.missing_ttl)))
+            for task, (chunk_summary, chunk_metrics) in zip(tasks, pool.imap(_enrich_chunk, tasks)):
+                summary.merge(chunk_summary)
+                METRICS.merge(chunk_metrics)
+                with open(task[5], 'r', newline='') as chunk:
+                    for row in csv.reader(chunk):
+                        region, values = row[0], row[1:]
+                        combined.writerow(values)
+                        if region in region_writers:
+                            region_writers[region].writerow(values)
+                        for output_writer in output_writers:
+                            output_writer.writerow(values)
+                os.remove(task[5])
+    finally:
+        shutil.rmtree(chunk_folder, ignore_errors=True)
+
+    return summary
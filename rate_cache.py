@@ -0,0 +1,190 @@
+"""Persistent SQLite cache of GSA destination rates keyed by fiscal year, zip and state."""
+import argparse
+import glob
+import json
+import sqlite3
+import threading
+import time
+
+
+class RateCache(object):
+    """
+    Indexed on-disk store of serialized Gsa_Destination_Rate records.
+    Records are the same dicts written to the legacy rates_<FY>.json files and are committed as they are stored.
+    Rate keys GSA had no rates for are kept in missing_rates with the time they were checked.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS destination_rates (
+                                  fiscal_year TEXT NOT NULL,
+                                  zipcode TEXT NOT NULL,
+                                  state TEXT NOT NULL,
+                                  record TEXT NOT NULL,
+                                  PRIMARY KEY (fiscal_year, zipcode, state)
+                              ) WITHOUT ROWID''')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS missing_rates (
+                                  fiscal_year TEXT NOT NULL,
+                                  zipcode TEXT NOT NULL,
+                                  state TEXT NOT NULL,
+                                  reason TEXT NOT NULL,
+                                  checked REAL NOT NULL,
+                                  PRIMARY KEY (fiscal_year, zipcode, state)
+                              ) WITHOUT ROWID''')
+        self._conn.commit()
+
+    @staticmethod
+    def split_key(rate_key):
+        """Split a get_rate_key key into (fiscal_year, zipcode, state)."""
+        fiscal_year, zipcode, state = rate_key.split(':')
+        return fiscal_year, zipcode, state
+
+    def get(self, rate_key):
+        """Get the serialized record for a rate key or None."""
+        with self._lock:
+            row = self._conn.execute('SELECT record FROM destination_rates '
+                                     'WHERE fiscal_year = ? AND zipcode = ? AND state = ?',
+                                     self.split_key(rate_key)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, rate_key, record):
+        """Store and commit a serialized record."""
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO destination_rates VALUES (?, ?, ?, ?)',
+                               self.split_key(rate_key) + (json.dumps(record, sort_keys=True),))
+            self._conn.execute('DELETE FROM missing_rates WHERE fiscal_year = ? AND zipcode = ? AND state = ?',
+                               self.split_key(rate_key))
+            self._conn.commit()
+
+    def records(self, fiscal_year, state):
+        """Serialized records for every cached destination in a state."""
+        with self._lock:
+            rows = self._conn.execute('SELECT record FROM destination_rates WHERE fiscal_year = ? AND state = ?',
+                                      (str(fiscal_year), state.upper())).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_missing(self, rate_key):
+        """(reason, checked) for a key GSA had no rates for, or None. checked is a time.time() timestamp."""
+        with self._lock:
+            return self._conn.execute('SELECT reason, checked FROM missing_rates '
+                                      'WHERE fiscal_year = ? AND zipcode = ? AND state = ?',
+                                      self.split_key(rate_key)).fetchone()
+
+    def put_missing(self, rate_key, reason):
+        """Store and commit a rate key GSA had no rates for."""
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO missing_rates VALUES (?, ?, ?, ?, ?)',
+                               self.split_key(rate_key) + (reason, time.time()))
+            self._conn.commit()
+
+    def clear_missing(self):
+        """Forget every missing rate key so they are requested again. Returns the number cleared."""
+        with self._lock:
+            cleared = self._conn.execute('DELETE FROM missing_rates').rowcount
+            self._conn.commit()
+        return cleared
+
+    def __contains__(self, rate_key):
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM destination_rates '
+                                     'WHERE fiscal_year = ? AND zipcode = ? AND state = ?',
+                                     self.split_key(rate_key)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM destination_rates').fetchone()[0]
+
+    def keys(self, fiscal_year=None):
+        """Rate keys in the cache, optionally for one fiscal year."""
+        query = 'SELECT fiscal_year, zipcode, state FROM destination_rates'
+        params = ()
+        if fiscal_year is not None:
+            query += ' WHERE fiscal_year = ?'
+            params = (str(fiscal_year),)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return ['{}:{}:{}'.format(*row) for row in rows]
+
+    def import_json(self, json_path):
+        """One time import of a legacy rates_<FY>.json cache. Returns the number of records imported."""
+        with open(json_path, 'r') as json_file:
+            key_rates = json.load(json_file)
+
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO destination_rates VALUES (?, ?, ?, ?)',
+                                   [self.split_key(key) + (json.dumps(record, sort_keys=True),)
+                                    for key, record in key_rates.items()])
+            self._conn.commit()
+
+        return len(key_rates)
+
+    def export_json(self, json_path, fiscal_year):
+        """Write one fiscal year back out in the legacy rates_<FY>.json format."""
+        with self._lock:
+            rows = self._conn.execute('SELECT fiscal_year, zipcode, state, record FROM destination_rates '
+                                      'WHERE fiscal_year = ?', (str(fiscal_year),)).fetchall()
+        key_rates = {'{}:{}:{}'.format(*row[:3]): json.loads(row[3]) for row in rows}
+        with open(json_path, 'w') as f_out:
+            f_out.write(json.dumps(key_rates, sort_keys=True, indent=4))
+
+        return len(key_rates)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == '__main__':
+    import perdiem  # imported here, perdiem imports this module
+    parser = argparse.ArgumentParser(description='Manage the SQLite GSA rate cache.')
+    parser.add_argument('command', choices=['import', 'export', 'clear-missing', 'warm'])
+    parser.add_argument('--db', default='gsa_destination_rates/rates.sqlite')
+    parser.add_argument('--json', nargs='*', default=None,
+                        help='json files to import, defaults to gsa_destination_rates/rates_*.json')
+    parser.add_argument('--fiscal-year', help='fiscal year to export, or to warm from --history')
+    parser.add_argument('--stays', nargs='*', default=[], help='warm the rates for the non-Utah stays in these csvs')
+    parser.add_argument('--history', action='store_true',
+                        help='warm --fiscal-year rates for every zip in the json files and the cache')
+    parser.add_argument('--fetch-workers', type=int, default=4, help='concurrent GSA requests while warming')
+    parser.add_argument('--requests-per-second', type=perdiem.positive_float, default=None,
+                        help='sustained GSA request rate')
+    args = parser.parse_args()
+    if args.command == 'export' and args.fiscal_year is None:
+        parser.error('export requires --fiscal-year')
+    if args.command == 'warm' and not args.stays and not (args.history and args.fiscal_year):
+        parser.error('warm requires --stays or --history with --fiscal-year')
+
+    json_paths = args.json or sorted(glob.glob('gsa_destination_rates/rates_*.json'))
+    gsa_rates = perdiem.GsaRateProvider(session=perdiem.GSA_SESSION, limiter=perdiem.GSA_RATE_LIMITER)
+    # a new cache gets the legacy json imported, the same as a perdiem.py run
+    cache = perdiem.open_rate_cache(args.db, () if args.command == 'import' else json_paths, gsa_rates)
+    if args.command == 'import':
+        for json_path in json_paths:
+            print('Imported {} rates from {}'.format(cache.import_json(json_path), json_path))
+    elif args.command == 'clear-missing':
+        print('Cleared {} missing GSA rates'.format(cache.clear_missing()))
+    elif args.command == 'warm':
+        if args.requests_per_second is not None:
+            perdiem.GSA_RATE_LIMITER.set_rate(args.requests_per_second)
+        gsa_rates.session = perdiem.configure_gsa_session(pool_size=max(args.fetch_workers, 1))
+        rate_requests = {}
+        for stays in args.stays:
+            rate_requests.update(perdiem.collect_rate_requests(stays))
+        if args.history:
+            history_requests = perdiem.collect_history_requests(args.fiscal_year, json_paths, cache)
+            rate_requests.update((key, request) for key, request in history_requests.items()
+                                 if key not in rate_requests)
+        start = time.time()
+        perdiem.print_coverage(perdiem.warm_rates(rate_requests, gsa_rates, args.fetch_workers))
+        print('Warmed in {:.1f} seconds'.format(time.time() - start))
+    else:
+        json_path = 'gsa_destination_rates/rates_{}.json'.format(args.fiscal_year)
+        print('Exported {} rates to {}'.format(cache.export_json(json_path, args.fiscal_year), json_path))
+    cache.close()
@@ -0,0 +1,125 @@
+"""
+Typed columnar result datasets written alongside the Sheets csv.
+Results are partitioned by fiscal year and quarter so later analysis reads only the partitions and columns it needs:
+
+    results/dataset/fiscal_year=2020/quarter=q3/results.parquet
+
+Requires pyarrow.
+"""
+import os
+
+from utah_perdiem import parse_date
+
+DATASET_FORMATS = ('parquet', 'arrow')
+BATCH_ROWS = 65536  # rows buffered per row group / record batch
+COMPRESSION = 'zstd'
+
+
+class ColumnarResultWriter(object):
+    """
+    Write result rows to one partition of a parquet or arrow dataset.
+    PERDIEM is written as an integer and *_DATE columns as dates, everything else as text.
+    The partition file is replaced when the writer is closed, so a rerun of a quarter overwrites it.
+    - dataset_folder: root folder of the dataset.
+    - fieldnames: result columns in the order values are passed to writerow.
+    - fiscal_year, quarter: partition of the rows.
+    - dataset_format: 'parquet' or 'arrow'.
+    """
+
+    def __init__(self, dataset_folder, fieldnames, fiscal_year, quarter, dataset_format='parquet',
+                 batch_rows=BATCH_ROWS):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('pyarrow is required to write {} results'.format(dataset_format))
+        if dataset_format not in DATASET_FORMATS:
+            raise ValueError('Unknown dataset format: {}'.format(dataset_format))
+        self._pa = pyarrow
+        self.fieldnames = list(fieldnames)
+        self.batch_rows = batch_rows
+        self.rows = 0
+        self.schema = pyarrow.schema([(field, self._column_type(field)) for field in self.fieldnames])
+        self._converters = [self._converter(field) for field in self.fieldnames]
+        self._columns = [[] for field in self.fieldnames]
+
+        partition_folder = os.path.join(dataset_folder, 'fiscal_year={}'.format(fiscal_year),
+                                        'quarter={}'.format(quarter))
+        os.makedirs(partition_folder, exist_ok=True)
+        self.path = os.path.join(partition_folder, 'results.{}'.format(dataset_format))
+        self._partial_path = self.path + '.partial'
+        if dataset_format == 'parquet':
+            import pyarrow.parquet
+            self._writer = pyarrow.parquet.ParquetWriter(self._partial_path, self.schema, compression=COMPRESSION)
+        else:
+            import pyarrow.ipc
+            self._writer = pyarrow.ipc.new_file(self._partial_path, self.schema,
+                                                options=pyarrow.ipc.IpcWriteOptions(compression=COMPRESSION))
+
+    def _column_type(self, field):
+        if field == 'PERDIEM':
+            return self._pa.int32()
+        if field.endswith('_DATE'):
+            return self._pa.date32()
+        return self._pa.string()
+
+    def _converter(self, field):
+        if field == 'PERDIEM':
+            return _to_int
+        if field.endswith('_DATE'):
+            return _to_date
+        return str
+
+    def writerow(self, values):
+        for column, converter, value in zip(self._columns, self._converters, values):
+            column.append(converter(value))
+        self.rows += 1
+        if len(self._columns[0]) >= self.batch_rows:
+            self._write_batch()
+
+    def _write_batch(self):
+        if not self._columns[0]:
+            return
+        batch = self._pa.record_batch([self._pa.array(column, type=field.type)
+                                       for column, field in zip(self._columns, self.schema)], schema=self.schema)
+        if hasattr(self._writer, 'write_batch'):
+            self._writer.write_batch(batch)
+        else:
+            self._writer.write_table(self._pa.Table.from_batches([batch]))
+        self._columns = [[] for field in self.fieldnames]
+
+    def close(self):
+        """Write the buffered rows and replace the partition file."""
+        self._write_batch()
+        self._writer.close()
+        os.replace(self._partial_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._writer.close()
+            os.remove(self._partial_path)
+
+
+def _to_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_date(value):
+    try:
+        return parse_date(str(value).strip()).date()
+    except ValueError:
+        return None
+
+
+def dataset_writer_factory(dataset_folder, fiscal_year, quarter, dataset_format='parquet'):
+    """A result writer factory for the pipeline and combine stages: called with the result fieldnames."""
+    def open_writer(fieldnames):
+        return ColumnarResultWriter(dataset_folder, fieldnames, fiscal_year, quarter, dataset_format)
+    return open_writer
@@ -0,0 +1,192 @@
+"""Counters, histograms and a throttled progress line for per diem runs."""
+import bisect
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+
+# histogram bucket upper bounds in seconds, the last bucket holds everything slower
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+PROGRESS_SECONDS = 2.0  # least time between progress lines
+PROGRESS_CHECK_ROWS = 1024  # rows between progress clock checks
+
+
+class Histogram(object):
+    """Bucketed distribution of observed values with count, sum, min and max."""
+
+    def __init__(self, bounds=SECONDS_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, or max for the overflow bucket."""
+        if not self.count:
+            return None
+        seen = 0
+        for i, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= q * self.count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': round(self.total, 6),
+                'mean': round(self.total / self.count, 6) if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'buckets': {('le_{}'.format(bound) if i < len(self.bounds) else 'inf'): self.buckets[i]
+                            for i, bound in enumerate(self.bounds + [None]) if self.buckets[i]}}
+
+
+class RunMetrics(object):
+    """
+    Thread safe counters and histograms for one run.
+    Counters are dotted names, e.g. cache.db_hits, gsa.api_requests, skipped.bad_checkin.
+    Rows counted with row() drive rows/sec and the progress line.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.progress_stream = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.rows = 0
+            self.started = time.time()
+            self._progress_at = time.monotonic()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def skip(self, reason):
+        """Count a stay left out of the results."""
+        self.incr('skipped.' + reason.replace(' ', '_'))
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Add the seconds spent in the block to the time.<name> counter."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.incr('time.' + name, time.perf_counter() - start)
+
+    def row(self, n=1):
+        """Count processed stays and write a progress line when one is due."""
+        self.rows += n
+        if self.progress_stream is not None and (n > 1 or self.rows % PROGRESS_CHECK_ROWS == 0):
+            now = time.monotonic()
+            if now - self._progress_at >= PROGRESS_SECONDS:
+                self._progress_at = now
+                self.progress_stream.write(self.progress_line() + '\n')
+                self.progress_stream.flush()
+
+    def cache_hit_rate(self):
+        """Share of GSA rate lookups answered without calling the API."""
+        hits = sum(n for name, n in self.counters.items() if name.startswith('cache.') and name.endswith('_hits'))
+        lookups = hits + self.counters.get('cache.misses', 0)
+        return hits / float(lookups) if lookups else None
+
+    def progress_line(self):
+        elapsed = time.time() - self.started
+        hit_rate = self.cache_hit_rate()
+        return '{:,} rows {:,.0f} rows/sec  {} GSA requests  cache hit {}  {} skipped'.format(
+            self.rows,
+            self.rows / elapsed if elapsed else 0,
+            self.counters.get('gsa.api_requests', 0),
+            '-' if hit_rate is None else '{:.1%}'.format(hit_rate),
+            sum(n for name, n in self.counters.items() if name.startswith('skipped.')))
+
+    def merge(self, other):
+        """Add the counts of another run, e.g. a worker process."""
+        with self._lock:
+            self.rows += other.rows
+            for name, n in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, histogram in other.histograms.items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(histogram.bounds)
+                self.histograms[name].merge(histogram)
+
+    def report(self):
+        """Run report as a json serializable dict."""
+        with self._lock:
+            elapsed = time.time() - self.started
+            return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                    'elapsed_seconds': round(elapsed, 3),
+                    'rows': self.rows,
+                    'rows_per_second': round(self.rows / elapsed, 1) if elapsed else None,
+                    'cache_hit_rate': self.cache_hit_rate(),
+                    'counters': {name: round(n, 6) if isinstance(n, float) else n
+                                 for name, n in sorted(self.counters.items())},
+                    'histograms': {name: histogram.to_dict() for name, histogram in sorted(self.histograms.items())}}
+
+    def write_report(self, json_path):
+        with open(json_path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=4)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        state['progress_stream'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+METRICS = RunMetrics()  # shared by every module of a run
+
+
+@contextlib.contextmanager
+def profiled(stats_path=None, top=25):
+    """Run the block under cProfile when stats_path is set, saving the stats and printing the slowest calls."""
+    if stats_path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(stats_path)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(top)
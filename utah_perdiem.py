@@ -1,59 +1,435 @@
 """Create perdiem data for Utah hotel stays."""
+import argparse
 import csv
+import difflib
+import functools
+import mmap
 import os
+import re
+import struct
+import threading
+from array import array
+from bisect import bisect_right
+from collections import Counter, OrderedDict, defaultdict
 from datetime import datetime
 
+from run_metrics import METRICS
+
 
 class RateArea(object):
     "Store rate information for Utah cities."
-    Areas = {}
 
     def __init__(self, name):
         self.name = name
         self._rate_periods = []
-        RateArea.Areas[name] = self
+        self._begins = None  # begin dates of the sorted periods, built after loading or on the next lookup
+        self._max_ends = None  # running max of period ends so overlapping periods are still found
 
     def add_rate_period(self, begin, end, rate):
+        if end < begin:
+            raise ValueError('{} rate period ends before it begins: {} {}'.format(self.name, begin, end))
         self._rate_periods.append((begin, end, rate))
+        self._begins = None
+
+    def _build_index(self):
+        """Sort the periods and build the lookup index. _begins is assigned last as lookups check it."""
+        periods = sorted(self._rate_periods, key=lambda period: period[:2])
+        max_ends = []
+        max_end = None
+        for begin, end, rate in periods:
+            max_end = end if max_end is None or end > max_end else max_end
+            max_ends.append(max_end)
+        self._rate_periods = periods
+        self._max_ends = max_ends
+        self._begins = [begin for begin, end, rate in periods]
+
+    def rate_periods(self):
+        """(begin, end, rate) periods sorted by begin date."""
+        if self._begins is None:
+            self._build_index()
+        return list(self._rate_periods)
+
+    def find_overlaps(self):
+        """Pairs of rate periods whose date ranges overlap."""
+        periods = self.rate_periods()
+        overlaps = []
+        for i, period in enumerate(periods):
+            for later in periods[i + 1:]:
+                if later[0] > period[1]:
+                    break
+                overlaps.append((period, later))
+        return overlaps
 
     def get_rate(self, date):
-        for period in self._rate_periods:
-            begin, end, rate = period
-            if date >= begin and date <= end:
+        """Rate for the period containing date. Overlapping periods resolve to the latest begin date."""
+        if self._begins is None:
+            self._build_index()
+        i = bisect_right(self._begins, date) - 1
+        while i >= 0 and self._max_ends[i] >= date:
+            begin, end, rate = self._rate_periods[i]
+            if end >= date:
                 return rate
+            i -= 1
 
         return None
 
+    def get_rates(self, dates):
+        """Rates for many check-in dates. Dates are resolved in sorted order so the index is walked once."""
+        if self._begins is None:
+            self._build_index()
+        begins, max_ends, periods = self._begins, self._max_ends, self._rate_periods
+        rates = [None] * len(dates)
+        after = 0  # first period beginning after the current date
+        for i in sorted(range(len(dates)), key=dates.__getitem__):
+            date = dates[i]
+            while after < len(begins) and begins[after] <= date:
+                after += 1
+            j = after - 1
+            while j >= 0 and max_ends[j] >= date:
+                begin, end, rate = periods[j]
+                if end >= date:
+                    rates[i] = rate
+                    break
+                j -= 1
+        return rates
+
+
+DEFAULT_CITY = 'all other utah cities'  # rate area used for Utah cities without their own rates
+FUZZY_CITY_CUTOFF = 0.85  # least difflib similarity for a misspelled city to match a rate area
+RESOLVED_CITIES = 4096  # matched stay city spellings remembered by RateAreas.resolve
+COMPILED_SUFFIX = '.compiled'  # compiled rate table written next to the rates csv
+
+CITY_ABBREVIATIONS = {'saint': 'st', 'mount': 'mt', 'fort': 'ft', 'n': 'north', 's': 'south', 'so': 'south',
+                      'e': 'east', 'w': 'west', 'hts': 'heights', 'spgs': 'springs', 'cyn': 'canyon'}
+CITY_WORDS = {'city', 'cty'}
+COUNTY_WORDS = {'county', 'co', 'cnty'}
+STATE_WORDS = {'ut', 'utah'}
+
+# other names for cities in the rates csv, keyed by normalize_city name
+CITY_ALIASES = {
+    'slc': 'Salt Lake City',
+    'sugar house': 'Salt Lake City',
+    'heber valley': 'Heber',
+    'deer valley': 'Park City',
+    'canyons village': 'Park City',
+}
+
+# counties of Utah cities without their own rates, keyed by normalize_city name
+CITY_COUNTIES = {
+    'clearfield': 'Davis', 'kaysville': 'Davis', 'syracuse': 'Davis', 'fruit heights': 'Davis',
+    'payson': 'Utah', 'spanish fork': 'Utah', 'pleasant grove': 'Utah', 'lindon': 'Utah', 'saratoga springs': 'Utah',
+    'eagle mountain': 'Utah', 'vineyard': 'Utah', 'roy': 'Weber', 'south ogden': 'Weber', 'north ogden': 'Weber',
+    'riverdale': 'Weber', 'ivins': 'Washington', 'santa clara': 'Washington',
+    'kamas': 'Summit', 'coalville': 'Summit', 'escalante': 'Garfield', 'delta': 'Millard', 'castle dale': 'Emery',
+    'huntington': 'Emery', 'helper': 'Carbon', 'grantsville': 'Tooele', 'wendover': 'Tooele', 'hyrum': 'Cache',
+    'smithfield': 'Cache', 'north logan': 'Cache', 'randolph': 'Rich', 'parowan': 'Iron', 'manti': 'Sanpete',
+    'mt pleasant': 'Sanpete',
+}
 
-def create_rate_areas(perdiem_csv):
+
+def normalize_city(name):
     """
-    Create city rate areas and add rate date ranges.
-    - perdiem_csv: csv of perdiem rates for Utah cities."""
-    date_string = '%m/%d/%Y'
+    Comparable form of a city name: lower case words without punctuation, zip codes, 'city' or a trailing state.
+    'Salt Lake City, UT' and 'salt lake' are both 'salt lake'."""
+    words = [CITY_ABBREVIATIONS.get(word, word) for word in re.sub(r'[^a-z0-9]+', ' ', name.lower()).split()
+             if word not in CITY_WORDS and not word.isdigit()]
+    while len(words) > 1 and words[-1] in STATE_WORDS:
+        words.pop()
+    return ' '.join(words)
+
+
+class RateAreas(dict):
+    """
+    {city: RateArea} for the cities in the rates csv, keyed by normalize_city name.
+    resolve matches the city names of stays to rate areas, remembering the last RESOLVED_CITIES matched spellings.
+    - county_areas: {county: RateArea} of the most common city rate in each county rate period.
+    - fuzzy_cutoff: least similarity for a misspelled city to match, None to only match exact names and aliases.
+    """
+
+    def __init__(self, county_areas=None, fuzzy_cutoff=FUZZY_CITY_CUTOFF):
+        super(RateAreas, self).__init__()
+        self.county_areas = {} if county_areas is None else county_areas
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self._resolved = OrderedDict()  # raw stay city -> (RateArea, how it matched), least recently used first
+        self._resolved_lock = threading.Lock()
+
+    def resolve(self, raw_city):
+        """
+        Rate area for a stay's city and how it matched: 'city', 'alias', 'county' or 'fuzzy'.
+        (None, None) for cities that can't be matched. Those aren't remembered, so arbitrary input can't fill memory."""
+        with self._resolved_lock:
+            resolved = self._resolved.get(raw_city)
+            if resolved is not None:
+                self._resolved.move_to_end(raw_city)
+                return resolved
+        resolved = self._resolve(normalize_city(raw_city))
+        if resolved[0] is not None:
+            with self._resolved_lock:
+                self._resolved[raw_city] = resolved
+                while len(self._resolved) > RESOLVED_CITIES:
+                    self._resolved.popitem(last=False)
+        return resolved
+
+    def _resolve(self, city):
+        if city in self:
+            return self[city], 'city'
+        alias = normalize_city(CITY_ALIASES.get(city, ''))
+        if alias in self:
+            return self[alias], 'alias'
+
+        words = city.split()
+        county = None
+        if len(words) > 1 and words[-1] in COUNTY_WORDS:
+            county = ' '.join(words[:-1])
+        elif city in CITY_COUNTIES:
+            county = normalize_city(CITY_COUNTIES[city])
+        if county in self.county_areas:
+            return self.county_areas[county], 'county'
+
+        if self.fuzzy_cutoff is not None and city:
+            names = list(self) + [name for name in CITY_ALIASES if normalize_city(CITY_ALIASES[name]) in self]
+            for close in difflib.get_close_matches(city, names, 1, self.fuzzy_cutoff):
+                return self.get(close) or self[normalize_city(CITY_ALIASES[close])], 'fuzzy'
+        return None, None
+
+    def default_rate(self, date):
+        """The All Other Utah Cities rate for a date, DEFAULT_RATE when it has no period for the date."""
+        rate = self[DEFAULT_CITY].get_rate(date) if DEFAULT_CITY in self else None
+        return DEFAULT_RATE if rate is None else int(float(rate))
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_date(month_day_year):
+    """Parse a M/D/YYYY date. Memoized since stays repeat the same few hundred dates."""
+    return datetime.strptime(month_day_year, '%m/%d/%Y')
+
+
+def _read_rate_areas(perdiem_csv, fuzzy_cutoff):
+    """Parse the rates csv into RateAreas of city and county RateArea objects."""
+    county_rates = defaultdict(Counter)  # (county, begin, end) -> rate counts
+    city_areas = RateAreas(fuzzy_cutoff=fuzzy_cutoff)
     with open(perdiem_csv, 'r') as p_cities:
         reader = csv.DictReader(p_cities)
         for row in reader:
             if row['STATE'] != 'UT':
                 continue
-            city = row['CITY'].lower().replace('city', '').strip()
-            begin = datetime.strptime(row['BEG_DATE'].strip(), date_string)
-            end = datetime.strptime(row['END_DATE'].strip(), date_string)
+            city = normalize_city(row['CITY'])
+            begin = parse_date(row['BEG_DATE'].strip())
+            end = parse_date(row['END_DATE'].strip())
             rate = row['RATE'].replace('$', '').strip()
-            if city not in RateArea.Areas:
-                city_area = RateArea(city)
-                city_area.add_rate_period(begin, end, rate)
+            if city not in city_areas:
+                city_areas[city] = RateArea(city)
+            city_areas[city].add_rate_period(begin, end, rate)
+            county = normalize_city(row.get('COUNTY_LOCATION_DEFINED') or '')
+            if county:
+                county_rates[county, begin, end][rate] += 1
+
+    for (county, begin, end), rates in county_rates.items():
+        if county not in city_areas.county_areas:
+            city_areas.county_areas[county] = RateArea(county + ' county')
+        # ties go to the lower rate
+        rate = max(rates, key=lambda county_rate: (rates[county_rate], -float(county_rate)))
+        city_areas.county_areas[county].add_rate_period(begin, end, rate)
+
+    for rate_area in list(city_areas.values()) + list(city_areas.county_areas.values()):
+        rate_area._build_index()  # before the areas are shared, so lookups from threads never build it
+    return city_areas
+
+
+class CompiledRateArea(RateArea):
+    """RateArea over one area's periods in a memory-mapped CompiledRateTable. Periods are read only."""
+
+    def __init__(self, name, table, first, count):
+        self.name = name
+        self._table = table
+        self._first = first
+        self._end = first + count
+
+    def add_rate_period(self, begin, end, rate):
+        raise TypeError('Compiled rate areas are read only, edit the rates csv instead')
+
+    def rate_periods(self):
+        """(begin, end, rate) periods sorted by begin date."""
+        table = self._table
+        return [(datetime.fromordinal(table.begins[i]), datetime.fromordinal(table.ends[i]), table.rate(i))
+                for i in range(self._first, self._end)]
+
+    def get_rate(self, date):
+        """Rate for the period containing date. Overlapping periods resolve to the latest begin date."""
+        table = self._table
+        day = date.toordinal()
+        i = bisect_right(table.begins, day, self._first, self._end) - 1
+        while i >= self._first and table.max_ends[i] >= day:
+            if table.ends[i] >= day:
+                return table.rate(i)
+            i -= 1
+
+        return None
+
+    def get_rates(self, dates):
+        """Rates for many check-in dates."""
+        return [self.get_rate(date) for date in dates]
+
+
+class CompiledRateTable(object):
+    """
+    Binary form of the rates csv's rate areas, written next to the csv and memory-mapped by every process.
+    Layout, native byte order:
+    - header: COMPILED_HEADER with the csv size and mtime it was compiled from.
+    - areas: 5 int32 per area (name offset, name length, county flag, first period, period count), sorted by
+      county flag and name.
+    - names: utf-8 area names.
+    - periods: int32 arrays of begin and end day numbers (date.toordinal), running max end and rate in cents,
+      sorted by begin and end within each area.
+    """
+    MAGIC = b'UTRATES1'
+    HEADER = struct.Struct('=8sqqIII')  # magic, csv size, csv mtime_ns, areas, periods, names bytes
+
+    def __init__(self, compiled_path):
+        with open(compiled_path, 'rb') as compiled:
+            self._map = mmap.mmap(compiled.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        magic, self.source_size, self.source_mtime, area_count, period_count, names_size = \
+            self.HEADER.unpack_from(view)
+        if magic != self.MAGIC:
+            raise ValueError('Not a compiled rate table: {}'.format(compiled_path))
+        offset = self.HEADER.size
+        self.areas = view[offset:offset + area_count * 20].cast('i')
+        offset += area_count * 20
+        self.names = bytes(view[offset:offset + names_size])
+        offset += (names_size + 3) // 4 * 4
+        self.begins, self.ends, self.max_ends, self.cents = (
+            view[offset + i * period_count * 4:offset + (i + 1) * period_count * 4].cast('i') for i in range(4))
+
+    def is_current(self, perdiem_csv):
+        source = os.stat(perdiem_csv)
+        return (self.source_size, self.source_mtime) == (source.st_size, source.st_mtime_ns)
+
+    def rate(self, i):
+        return '{:.2f}'.format(self.cents[i] / 100.0)
+
+    def rate_areas(self, fuzzy_cutoff=FUZZY_CITY_CUTOFF):
+        """RateAreas of CompiledRateArea objects."""
+        city_areas = RateAreas(fuzzy_cutoff=fuzzy_cutoff)
+        for i in range(0, len(self.areas), 5):
+            name_offset, name_length, is_county, first, count = self.areas[i:i + 5]
+            name = self.names[name_offset:name_offset + name_length].decode('utf-8')
+            area = CompiledRateArea(name, self, first, count)
+            if is_county:
+                city_areas.county_areas[name[:-len(' county')]] = area
             else:
-                RateArea.Areas[city].add_rate_period(begin, end, rate)
+                city_areas[name] = area
+        return city_areas
+
+    @classmethod
+    def write(cls, city_areas, perdiem_csv, compiled_path):
+        """Compile RateAreas built from perdiem_csv. The file is replaced atomically."""
+        source = os.stat(perdiem_csv)
+        areas, names = array('i'), bytearray()
+        begins, ends, max_ends, cents = array('i'), array('i'), array('i'), array('i')
+        named_areas = sorted([(0, name, area) for name, area in city_areas.items()] +
+                             [(1, area.name, area) for area in city_areas.county_areas.values()])
+        for is_county, name, area in named_areas:
+            periods = area.rate_periods()
+            encoded = name.encode('utf-8')
+            areas.extend([len(names), len(encoded), is_county, len(begins), len(periods)])
+            names += encoded
+            max_end = None
+            for begin, end, rate in periods:
+                max_end = end if max_end is None or end > max_end else max_end
+                begins.append(begin.toordinal())
+                ends.append(end.toordinal())
+                max_ends.append(max_end.toordinal())
+                cents.append(int(round(float(rate) * 100)))
+        names_size = len(names)
+        names += b'\0' * (-names_size % 4)
+
+        partial_path = '{}.{}.partial'.format(compiled_path, os.getpid())
+        with open(partial_path, 'wb') as compiled:
+            compiled.write(cls.HEADER.pack(cls.MAGIC, source.st_size, source.st_mtime_ns, len(named_areas),
+                                           len(begins), names_size))
+            for part in (areas, names, begins, ends, max_ends, cents):
+                compiled.write(part.tobytes() if isinstance(part, array) else bytes(part))
+        os.replace(partial_path, compiled_path)
+
+
+def compile_rate_areas(perdiem_csv, compiled_path=None):
+    """
+    Compile the rates csv unless its compiled table is current. Returns the compiled table path.
+    Run before starting worker pools so the workers only map the table.
+    """
+    compiled_path = perdiem_csv + COMPILED_SUFFIX if compiled_path is None else compiled_path
+    if _load_compiled(perdiem_csv, compiled_path) is None:
+        CompiledRateTable.write(_read_rate_areas(perdiem_csv, None), perdiem_csv, compiled_path)
+    return compiled_path
 
-    return RateArea.Areas
+
+def _load_compiled(perdiem_csv, compiled_path):
+    """The current compiled table for perdiem_csv or None when it is missing, stale or unreadable."""
+    try:
+        table = CompiledRateTable(compiled_path)
+    except (OSError, ValueError, struct.error):
+        return None
+    return table if table.is_current(perdiem_csv) else None
+
+
+def create_rate_areas(perdiem_csv, strict=False, fuzzy_cutoff=FUZZY_CITY_CUTOFF, compiled=True):
+    """
+    Create city rate areas and add rate date ranges.
+    - perdiem_csv: csv of perdiem rates for Utah cities.
+    - strict: raise ValueError for overlapping rate periods instead of reporting them.
+    - fuzzy_cutoff: least similarity for misspelled stay cities to match a city, None to turn fuzzy matching off.
+    - compiled: map the compiled table next to the csv, compiling it first when the csv has changed.
+    Returns a new RateAreas {city: RateArea} dict."""
+    city_areas = None
+    if compiled:
+        compiled_path = perdiem_csv + COMPILED_SUFFIX
+        table = _load_compiled(perdiem_csv, compiled_path)
+        if table is not None:
+            city_areas = table.rate_areas(fuzzy_cutoff)
+    if city_areas is None:
+        city_areas = _read_rate_areas(perdiem_csv, fuzzy_cutoff)
+        if compiled:
+            try:
+                CompiledRateTable.write(city_areas, perdiem_csv, compiled_path)
+            except OSError as e:
+                print('Could not compile {}: {}'.format(perdiem_csv, e))
+
+    for city_area in city_areas.values():
+        for period, overlapping in city_area.find_overlaps():
+            msg = 'Overlapping rate periods for {}: {} and {}'.format(city_area.name, period, overlapping)
+            if strict:
+                raise ValueError(msg)
+            print(msg)
+
+    return city_areas
+
+
+DEFAULT_RATE = 70  # Used for dates the All Other Utah Cities rates in the rates csv don't cover.
+
+
+def get_stay_rate(city_areas, row):
+    """
+    Utah perdiem for a stay row. city_areas: RateAreas from create_rate_areas.
+    Returns (perdiem, city, not_found_message).
+    Stays that can't be matched get the All Other Utah Cities rate and a message."""
+    checkin = parse_date(row['CHECKIN_DATE'].strip())
+    rate_area, match = city_areas.resolve(row['CITY'])
+    if rate_area is None:
+        return city_areas.default_rate(checkin), normalize_city(row['CITY']), 'not found'
+    if match != 'city':
+        METRICS.incr('utah.{}_matches'.format(match))
+
+    rate = rate_area.get_rate(checkin)
+    if rate is None:
+        return city_areas.default_rate(checkin), rate_area.name, 'date not not_found ' + str(checkin)
+    return int(float(rate)), rate_area.name, None
 
 
 def get_rate_for_stays(city_areas, stay_csv, output_csv):
     """Add Utah travel rates to Utah hotel stays."""
-    date_string = '%m/%d/%Y'
     not_found = 0
     not_found_cities = {}
-    default_rate = 70  # This value can change each new fiscal year and can be found in rates csv.
     with open(stay_csv, 'r') as stays, open(output_csv, 'w', newline='') as output:
         reader = csv.DictReader(stays)
         writer = csv.writer(output)
@@ -64,26 +440,26 @@ def get_rate_for_stays(city_areas, stay_csv, output_csv):
         for row in reader:
             if row['STATE'].lower() != 'ut':
                 continue
-            city = row['CITY'].lower().replace('city', '').strip()
-            checkin = datetime.strptime(row['CHECKIN_DATE'].strip(), date_string)
-            id_num = row['ROW_ID']
-            if city not in city_areas:
-                not_found_cities[city] = 'not found'
-                row['PERDIEM'] = default_rate
-                writer.writerow([row[field] for field in reader.fieldnames])
+            try:
+                row['PERDIEM'], city, not_found_msg = get_stay_rate(city_areas, row)
+            except ValueError:
+                print('BAD CHECKIN', row['ROW_ID'].strip(), row['CHECKIN_DATE'].strip())
+                METRICS.skip('bad checkin')
+                continue
+            if not_found_msg is not None:
+                not_found_cities[city] = not_found_msg
                 not_found += 1
-            else:
-                rate = city_areas[city].get_rate(checkin)
-                if rate is None:
-                    not_found_cities[city] = 'date not not_found ' + str(checkin)
-                    row['PERDIEM'] = default_rate
-                    writer.writerow([row[field] for field in reader.fieldnames])
-                    not_found += 1
-                else:
-                    row['PERDIEM'] = int(float(rate))
-                    writer.writerow([row[field] for field in reader.fieldnames])
+                METRICS.incr('utah.default_rates')
+            writer.writerow([row[field] for field in reader.fieldnames])
 
     for not_found_city, msg in not_found_cities.items():  # cities not found in Utah rates. All not found are Utah default rate.
         print('{} {}'.format(not_found_city, msg))
     print('Total not found:', not_found)
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile Utah rates for memory-mapped lookups.')
+    parser.add_argument('command', choices=['compile'])
+    parser.add_argument('--utah-rates', default='utah_rates.csv')
+    args = parser.parse_args()
+    print('Compiled {} to {}'.format(args.utah_rates, compile_rate_areas(args.utah_rates)))
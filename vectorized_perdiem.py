@@ -0,0 +1,128 @@
+"""
+Columnar pandas engine for adding per diems to hotel stays.
+Produces the same csv output as perdiem.add_perdiem_from_gsa and utah_perdiem.get_rate_for_stays.
+"""
+import csv
+
+import pandas as pd
+
+import perdiem
+import utah_perdiem
+from run_metrics import METRICS
+
+DATE_FORMAT = '%m/%d/%Y'
+
+
+def read_stays(data):
+    """Read a stays csv once with every value kept as the raw string."""
+    return pd.read_csv(data, dtype=str, keep_default_na=False, na_filter=False)
+
+
+def _write_rows(stays, fieldnames, output_csv):
+    """Write rows the same way the csv engine does, including its header handling for PERDIEM."""
+    with open(output_csv, 'w', newline='') as output:
+        writer = csv.writer(output)
+        if 'PERDIEM' not in fieldnames:
+            writer.writerow(fieldnames + ['PERDIEM'])
+        else:
+            writer.writerow(fieldnames)
+        writer.writerows(stays[fieldnames].itertuples(index=False, name=None))
+
+
+def _parse_checkins(checkin_dates):
+    return pd.to_datetime(checkin_dates.str.strip(), format=DATE_FORMAT, errors='coerce')
+
+
+def add_perdiem_from_gsa(data, output_csv, fetch_workers=perdiem.FETCH_WORKERS, stays=None, rates=None):
+    """
+    Add GSA perdiem to the non-Utah stays with whole column parsing and a merge against the rate table.
+    rates: perdiem.GsaRateProvider, perdiem.GSA_RATES by default."""
+    rates = perdiem.GSA_RATES if rates is None else rates
+    if stays is None:
+        stays = read_stays(data)
+    fieldnames = list(stays.columns)
+    METRICS.row(len(stays))
+
+    state = stays['STATE'].str.strip()
+    checkin = _parse_checkins(stays['CHECKIN_DATE'])
+    fiscal_year = (checkin.dt.year + (checkin.dt.month >= 10)).astype('Int64').astype(str)
+    zipcode = stays['ZIP_CODE'].str.strip()
+    zip_plus4 = zipcode.str.match(perdiem.ZIP_PLUS4_MATCHER.pattern)
+    zipcode = zipcode.where(~zip_plus4, zipcode.str.split('-').str[0].str.strip())
+
+    keys = pd.DataFrame({'fiscal_year': fiscal_year,
+                         'zipcode': zipcode,
+                         'state': state,
+                         'city': stays['CITY'].str.strip(),
+                         'rate_month': checkin.dt.strftime(perdiem.RATE_DATE_FORMAT)})
+    bad_checkin = checkin.isna()
+    keys = keys[(state != 'UT') & ~bad_checkin]
+    print('Bad checkin dates:', int((bad_checkin & (state != 'UT')).sum()))
+    METRICS.incr('skipped.bad_checkin', int((bad_checkin & (state != 'UT')).sum()))
+
+    rate_requests = keys.drop_duplicates(['fiscal_year', 'zipcode', 'state'])
+    request_args = {perdiem.get_rate_key(fy, z, s): (s, c, z, fy)
+                    for fy, z, s, c in rate_requests[['fiscal_year', 'zipcode', 'state', 'city']].itertuples(index=False)}
+    if fetch_workers:
+        rates.prefetch(request_args, fetch_workers)
+
+    rate_rows = []
+    for state_, city, zipcode_, fiscal_year_ in request_args.values():
+        try:
+            destination = rates.get_destination_rate(state_, city, zipcode_, fiscal_year_)
+        except Exception as e:
+            print(e)
+            continue
+        for rate_month, rate in destination.rates.items():
+            rate_rows.append((fiscal_year_, zipcode_, state_, rate_month, str(rate)))
+    rate_table = pd.DataFrame(rate_rows, columns=['fiscal_year', 'zipcode', 'state', 'rate_month', 'PERDIEM'])
+
+    merged = (keys.drop(columns='city').reset_index()
+              .merge(rate_table, on=['fiscal_year', 'zipcode', 'state', 'rate_month'], how='inner')
+              .set_index('index').sort_index())
+    result = stays.loc[merged.index].copy()
+    result['PERDIEM'] = merged['PERDIEM']
+    _write_rows(result, fieldnames, output_csv)
+
+
+def get_rate_for_stays(city_areas, stay_csv, output_csv, stays=None):
+    """Add Utah travel rates to Utah hotel stays with an interval merge against the city rate periods."""
+    if stays is None:
+        stays = read_stays(stay_csv)
+    fieldnames = list(stays.columns)
+
+    utah = stays[stays['STATE'].str.lower() == 'ut']
+    checkin = _parse_checkins(utah['CHECKIN_DATE'])
+    print('Bad checkin dates:', int(checkin.isna().sum()))
+    METRICS.incr('skipped.bad_checkin', int(checkin.isna().sum()))
+    utah = utah[checkin.notna()].copy()
+    checkin = checkin[checkin.notna()]
+    if utah.empty:  # the empty frames below would not merge
+        _write_rows(utah, fieldnames, output_csv)
+        print('Total not found:', 0)
+        return
+    # resolve each distinct city spelling once
+    resolved = {raw_city: city_areas.resolve(raw_city)[0] for raw_city in utah['CITY'].unique()}
+    rate_areas = {area.name: area for area in resolved.values() if area is not None}
+    city = utah['CITY'].map({raw_city: area.name if area is not None else utah_perdiem.normalize_city(raw_city)
+                             for raw_city, area in resolved.items()})
+
+    periods = pd.DataFrame([(name, order, begin, end, int(float(rate)))
+                            for name, area in rate_areas.items()
+                            for order, (begin, end, rate) in enumerate(area.rate_periods())],
+                           columns=['city', 'order', 'begin', 'end', 'rate'])
+    matches = (pd.DataFrame({'city': city, 'checkin': checkin}).reset_index()
+               .merge(periods, on='city', how='inner'))
+    matches = matches[(matches['checkin'] >= matches['begin']) & (matches['checkin'] <= matches['end'])]
+    # overlapping periods resolve to the latest begin date like RateArea.get_rate
+    matches = matches.sort_values(['index', 'order']).drop_duplicates('index', keep='last')
+
+    rates = checkin.map({date: city_areas.default_rate(date) for date in checkin.unique()})
+    rates[matches['index'].to_numpy()] = matches['rate'].to_numpy()
+    utah['PERDIEM'] = rates.astype(str)
+    _write_rows(utah, fieldnames, output_csv)
+
+    not_found = utah.index.difference(matches['index'])
+    for not_found_city in city[not_found].unique():
+        print('{} {}'.format(not_found_city, 'not found'))
+    print('Total not found:', len(not_found))